@@ -0,0 +1,1138 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+# A local stand-in for the Harmony web services, for load testing MHManager
+# without touching (or depending on) the real service.  It answers the SOAP
+# operations that MHManager uses from a synthetic household, building the
+# replies from the bundled harmony.wsdl, as well as the login, account
+# registration and config download requests.  Latency and failures can be
+# added per operation.
+#
+# Usage: python3 benchmarks/harmony_server.py [--port N] [--accounts N]
+#            [--devices N] [--commands N] [--latency SECONDS]
+#            [--operation-latency Manager.Operation=SECONDS] ...
+#
+# MHManager is pointed at a running server with a LocalConnectionPool, e.g.
+#   MHManager(True, pool=LocalConnectionPool('http://127.0.0.1:8080'),
+#             product_cache=None)
+
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from suds.bindings.binding import envns
+from suds.client import Client
+from suds.mx import Content
+from suds.sax.element import Element
+from suds.sax.parser import Parser
+from congruity.mhmanager import ConnectionPool, CopyObject, DATA_NS
+
+XSI_INSTANCE_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+XSI = ('xsi', XSI_INSTANCE_NS)
+SOAP_ENC_NS = 'http://schemas.xmlsoap.org/soap/encoding/'
+
+MANUFACTURERS = ["Sony", "Samsung", "LG", "Panasonic", "Denon", "Yamaha",
+                 "Onkyo", "Philips", "Pioneer", "Toshiba"]
+DEVICE_TYPES = ["Television", "AVReceiver", "DVD", "SetTopBox", "GameConsole"]
+COMMAND_NAMES = ["PowerToggle", "PowerOn", "PowerOff", "VolumeUp",
+                 "VolumeDown", "Mute", "ChannelUp", "ChannelDown",
+                 "DirectionUp", "DirectionDown", "DirectionLeft",
+                 "DirectionRight", "Select", "Menu", "Guide", "Info", "Exit",
+                 "Play", "Pause", "Stop"]
+BUTTON_KEYS = ["Power", "VolumeUp", "VolumeDown", "Mute", "ChannelUp",
+               "ChannelDown", "DirectionUp", "DirectionDown", "DirectionLeft",
+               "DirectionRight", "OK", "Menu", "Guide", "Info", "Exit", "Play",
+               "Pause", "Stop", "Number0", "Number1", "Number2", "Number3",
+               "Number4", "Number5", "Number6", "Number7", "Number8",
+               "Number9"]
+ACTIVITY_TYPES = ["WatchTV", "WatchDvd", "ListenToMusic", "PlayGame"]
+ROLE_TYPES = ["DisplayActivityRole", "VolumeActivityRole",
+              "ChannelChangingActivityRole", "PlayMovieActivityRole"]
+# (skin id, display name, whether button mapping is done per activity)
+PRODUCTS = [(104, "Harmony 350", False), (66, "Harmony 650", True),
+            (78, "Harmony 200", False), (82, "Harmony Link", True)]
+COUNTRIES = [("US", "United States"), ("CA", "Canada"),
+             ("GB", "United Kingdom"), ("DE", "Germany"), ("FR", "France"),
+             ("AU", "Australia")]
+
+COMPILE_PATH = '/CompilerService/GetConfig'
+
+class Command:
+    def __init__(self, id, name, isLearned=False):
+        self.id = id
+        self.name = name
+        self.isLearned = isLearned
+        self.keyCode = str(id % 65536)
+
+class Device:
+    def __init__(self, id, accountId, manufacturer, model, deviceType):
+        self.id = id
+        self.accountId = accountId
+        self.name = manufacturer + " " + model
+        self.manufacturer = manufacturer
+        self.model = model
+        self.deviceType = deviceType
+        self.commands = []          # Command
+        self.buttonMapId = None
+        self.buttons = {}           # button key -> command id or channel
+        self.userButtons = {}       # button key -> command name
+        self.inputs = []            # input names
+
+    def FindCommand(self, id=None, name=None):
+        for command in self.commands:
+            if command.id == id or command.name == name:
+                return command
+        return None
+
+class Account:
+    def __init__(self, id, remoteId, surfaceId, skinId):
+        self.id = id
+        self.remoteId = remoteId
+        self.surfaceId = surfaceId
+        self.skinId = skinId
+        self.serialNumber = "%08X" % remoteId
+        self.remoteName = None
+        self.devices = []           # Device
+        self.activities = {}        # activity id -> Activity
+
+class Activity:
+    def __init__(self, id, name, type, roles):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.roles = roles          # [(role type, device id, input name)]
+
+# The synthetic household: accounts with one remote each, their devices and
+# commands, button assignments and activities.  Ids are allocated
+# sequentially, so a given set of parameters always gives the same household.
+class Household:
+    def __init__(self, accounts=1, devicesPerAccount=6, commandsPerDevice=50,
+                 activitiesPerAccount=3, inputsPerDevice=4, seed=0):
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1000)
+        self.random = random.Random(seed)
+        self.commandsPerDevice = commandsPerDevice
+        self.inputsPerDevice = inputsPerDevice
+        self.accounts = []
+        self.devices = {}           # device id -> Device
+        for i in range(accounts):
+            account = self.AddAccount(PRODUCTS[i % len(PRODUCTS)][0])
+            for j in range(devicesPerAccount):
+                self.AddDevice(account,
+                               self.random.choice(MANUFACTURERS),
+                               "%s-%d" % (chr(ord('A') + j % 26),
+                                          self.random.randrange(100, 10000)),
+                               DEVICE_TYPES[j % len(DEVICE_TYPES)])
+            for j in range(min(activitiesPerAccount, len(ACTIVITY_TYPES))):
+                roles = [(ROLE_TYPES[k % len(ROLE_TYPES)], device.id,
+                          device.inputs[0] if device.inputs else None)
+                         for k, device in enumerate(account.devices[:3])]
+                self.AddActivity(account, ACTIVITY_TYPES[j], ACTIVITY_TYPES[j],
+                                 roles)
+
+    def NextId(self):
+        return next(self.ids)
+
+    def AddAccount(self, skinId=None):
+        account = Account(self.NextId(), self.NextId(), self.NextId(), skinId)
+        self.accounts.append(account)
+        return account
+
+    def AddDevice(self, account, manufacturer, model, deviceType):
+        device = Device(self.NextId(), account.id, manufacturer, model,
+                        deviceType)
+        device.buttonMapId = self.NextId()
+        for i in range(self.commandsPerDevice):
+            if i < len(COMMAND_NAMES):
+                name = COMMAND_NAMES[i]
+            else:
+                name = "Command%d" % i
+            device.commands.append(Command(self.NextId(), name))
+        for key, command in zip(BUTTON_KEYS, device.commands):
+            device.buttons[key] = command.id
+        # The client expects every user button map to have some buttons.
+        for key, command in zip(BUTTON_KEYS, device.commands[:3]):
+            device.userButtons[key] = command.name
+        device.inputs = ["Input%d" % (i + 1)
+                         for i in range(self.inputsPerDevice)]
+        account.devices.append(device)
+        self.devices[device.id] = device
+        return device
+
+    def AddActivity(self, account, name, type, roles):
+        activity = Activity(self.NextId(), name, type, roles)
+        account.activities[activity.id] = activity
+        return activity
+
+    def FindAccount(self, id=None, remoteId=None):
+        for account in self.accounts:
+            if account.id == id or account.remoteId == remoteId:
+                return account
+        return None
+
+    def RemoveAccount(self, account):
+        self.accounts.remove(account)
+        for device in account.devices:
+            del self.devices[device.id]
+
+    def RemoveDevice(self, device):
+        account = self.FindAccount(device.accountId)
+        if account is not None:
+            account.devices.remove(device)
+        del self.devices[device.id]
+
+# Gives every namespace used in a reply envelope a single prefix, declared on
+# the envelope.  The suds marshaller reuses prefixes for different namespaces
+# in different parts of the tree, which the client's prefix promotion then
+# gets wrong for the xsi:type attributes of polymorphic values.
+def NormalizePrefixes(envelope):
+    nodes = []
+    stack = [envelope]
+    while stack:
+        node = stack.pop()
+        typeName = node.get('type', XSI)
+        if typeName is not None:
+            typePrefix, _, name = typeName.rpartition(':')
+            typeName = (node.resolvePrefix(typePrefix or None)[1], name)
+        nodes.append((node, node.namespace()[1], typeName))
+        stack.extend(reversed(node.getChildren()))
+    prefixes = {envns[1]: envns[0], XSI_INSTANCE_NS: 'xsi',
+                SOAP_ENC_NS: 'SOAP-ENC'}
+    for node, namespace, typeName in nodes:
+        node.nsprefixes = {}
+        node.expns = None
+        node.prefix = None
+        if namespace is not None:
+            node.prefix = prefixes.setdefault(namespace,
+                                              'ns%d' % len(prefixes))
+        if typeName is not None:
+            typePrefix = prefixes.setdefault(typeName[0],
+                                             'ns%d' % len(prefixes))
+            node.set('xsi:type', '%s:%s' % (typePrefix, typeName[1]))
+    for namespace, prefix in prefixes.items():
+        envelope.addPrefix(prefix, namespace)
+    return envelope
+
+# Helpers for reading request parameters, which are suds sax Elements.
+def Text(node, *path):
+    for name in path:
+        if node is None:
+            return None
+        node = node.getChild(name)
+    if node is None or node.get('nil', XSI) == 'true':
+        return None
+    return node.getText()
+
+def IdValue(node, *path):
+    value = Text(node, *(path + ('Value',)))
+    if value is None:
+        return None
+    return int(value)
+
+def TypeName(node):
+    return (node.get('type', XSI) or '').rpartition(':')[2]
+
+def Items(node, name=None):
+    if node is None:
+        return []
+    if name is None:
+        return node.getChildren()
+    return node.getChildren(name)
+
+# Raised by operation handlers to return a SOAP fault.
+class Fault(Exception):
+    pass
+
+# Builds SOAP replies for the operations MHManager uses from a Household.
+# Each operation is handled by the method of the same name, which is passed
+# the request parameters (sax Elements) and returns the result value, or an
+# Element list for results whose type is <any/>.  Operations without a
+# handler get an empty result.
+class Service:
+    def __init__(self, household, compilePolls=1, configSize=65536):
+        wsdl = os.path.join(os.path.dirname(__file__), os.pardir, 'congruity',
+                            'harmony.wsdl')
+        self.client = Client(Path(os.path.abspath(wsdl)).as_uri(),
+                             cache=None)
+        self.household = household
+        self.compilePolls = compilePolls
+        self.configSize = configSize
+        self.compilations = {}      # compilation id -> remaining polls
+        self.methods = {}
+        self.actions = {}           # SOAPAction -> (manager, operation)
+        for service in self.client.wsdl.services:
+            for port in service.ports:
+                manager = port.name
+                if manager.endswith('PortType'):
+                    manager = manager[:-len('PortType')]
+                for name, method in port.methods.items():
+                    self.methods[(manager, name)] = method
+                    self.actions[method.soap.action.strip('"')] = \
+                        (manager, name)
+        self.prototypes = {}
+
+    def Create(self, typeName):
+        prototype = self.prototypes.get(typeName)
+        if prototype is None:
+            prototype = self.client.factory.create(typeName)
+            self.prototypes[typeName] = prototype
+        return CopyObject(prototype)
+
+    # Returns a new instance for the named child of parent, or of the named
+    # subtype of it.
+    def New(self, parent, name, typeName=None):
+        child, ancestry = parent.__metadata__.sxtype.get_child(name)
+        resolved = child.resolve()
+        return self.Create('{%s}%s' % (resolved.namespace()[1],
+                                       typeName or resolved.name))
+
+    def NewId(self, value, typeName='Id'):
+        id = self.Create('{%s}%s' % (DATA_NS, typeName))
+        id.IsPersisted = True
+        id.Value = value
+        return id
+
+    # Appends value to the named list child of parent.  Some of the repeated
+    # elements are not declared as such in the schema, so the list is created
+    # here if needed.
+    def Append(self, parent, name, value):
+        items = getattr(parent, name)
+        if not isinstance(items, list):
+            items = []
+            setattr(parent, name, items)
+        items.append(value)
+
+    # Returns the (manager, operation) for a SOAPAction, or None.
+    def Operation(self, action):
+        return self.actions.get(action.strip('"'))
+
+    # Returns the reply envelope (bytes) for the given request body.
+    def Call(self, manager, operation, body):
+        method = self.methods[(manager, operation)]
+        envelope = Parser().parse(string=body).root()
+        request = envelope.getChild('Body').getChildren()[0]
+        handler = getattr(self, operation, None)
+        parts = method.soap.output.body.parts
+        # Parameters that are None are left out of the request.
+        args = [request.getChild(part.name)
+                for part in method.soap.input.body.parts]
+        with self.household.lock:
+            if handler is not None:
+                value = handler(*args)
+            elif parts:
+                value = self.CreateResult(method)
+            else:
+                value = None
+        return self.Reply(method, value)
+
+    def CreateResult(self, method):
+        typeName, namespace = method.soap.output.body.parts[0].type
+        return self.Create('{%s}%s' % (namespace, typeName))
+
+    def Reply(self, method, value):
+        binding = method.binding.output
+        response = Element(method.name + 'Response',
+                           ns=method.soap.output.body.namespace)
+        if method.soap.output.body.parts:
+            type = binding.returned_types(method)[0]
+            if isinstance(value, list):
+                result = Element(type.name)
+                for child in value:
+                    result.append(child)
+            else:
+                result = binding.marshaller().process(
+                    Content(tag=type.name, value=value, type=type,
+                            real=type.resolve()))
+            response.append(result)
+        envelope = binding.envelope(Element('Header', ns=envns),
+                                    binding.body(response))
+        return NormalizePrefixes(envelope).str().encode('utf-8')
+
+    # Marshals a typed value as an element that carries its xsi:type, for
+    # results whose schema type is <any/>.
+    def Typed(self, method, tag, value):
+        type = value.__metadata__.sxtype
+        element = method.binding.output.marshaller().process(
+            Content(tag=tag, value=value, type=type, real=type))
+        element.set('xsi:type', 'ns0:' + type.name)
+        element.addPrefix('ns0', type.namespace()[1])
+        element.addPrefix('xsi', XSI_INSTANCE_NS)
+        return element
+
+    def FindDevice(self, node):
+        device = self.household.devices.get(IdValue(node))
+        if device is None:
+            raise Fault("Unknown device %s" % Text(node, 'Value'))
+        return device
+
+    def FindAccount(self, node):
+        account = self.household.FindAccount(IdValue(node))
+        if account is None:
+            raise Fault("Unknown account %s" % Text(node, 'Value'))
+        return account
+
+    def Devices(self, deviceIds):
+        return [self.FindDevice(node) for node in Items(deviceIds)]
+
+    # AccountManager
+
+    def GetMyHousehold(self):
+        result = self.CreateResult(self.methods[('AccountManager',
+                                                 'GetMyHousehold')])
+        for account in self.household.accounts:
+            self.Append(result.Accounts, 'Account',
+                        self.AccountObject(result.Accounts, account))
+        return result
+
+    def AccountObject(self, accounts, account):
+        value = self.New(accounts, 'Account')
+        value.Id = self.NewId(account.id)
+        for device in account.devices:
+            item = self.New(value.Devices, 'Device')
+            item.Id = self.NewId(device.id)
+            item.Name = device.name
+            self.Append(value.Devices, 'Device', item)
+        if account.skinId is not None:
+            remote = self.New(value.Remotes, 'Remote')
+            remote.Id = self.NewId(account.remoteId)
+            remote.SkinId = account.skinId
+            remote.SerialNumber = account.serialNumber
+            surface = self.New(remote.Surfaces, 'Surface')
+            surface.Id = self.NewId(account.surfaceId)
+            self.Append(remote.Surfaces, 'Surface', surface)
+            remote.RemoteProperties.RemoteName = account.remoteName
+            self.Append(value.Remotes, 'Remote', remote)
+        value.Properties.FirstName = "Load"
+        value.Properties.LastName = "Test"
+        value.Properties.Email = "loadtest@example.com"
+        value.Properties.CountryType = "US"
+        value.Properties.ContactMe = False
+        value.Properties.UserKey = str(uuid.UUID(int=account.id))
+        return value
+
+    def CreateNewAccountInMyHousehold(self):
+        account = self.household.AddAccount()
+        method = self.methods[('AccountManager',
+                               'CreateNewAccountInMyHousehold')]
+        result = self.CreateResult(method)
+        result.Id = self.NewId(account.id)
+        return result
+
+    def RemoveAccountFromHousehold(self, accountId):
+        self.household.RemoveAccount(self.FindAccount(accountId))
+        return "Successful"
+
+    def SecureControllerHandshake(self, nonce):
+        return self.CreateResult(self.methods[('AccountManager',
+                                               'SecureControllerHandshake')])
+
+    def UpdatePasswordByOldPassword(self, email, oldPassword, newPassword):
+        return "true"
+
+    # UserAccountDirector
+
+    def AddRemoteToAccount(self, remoteInfo):
+        account = self.FindAccount(remoteInfo.getChild('AccountId'))
+        account.skinId = int(Text(remoteInfo, 'SkinId'))
+        account.serialNumber = Text(remoteInfo, 'SerialNumber')
+        return self.NewId(account.remoteId)
+
+    def SimpleGetActivities(self, accountId):
+        account = self.FindAccount(accountId)
+        result = self.CreateResult(self.methods[('UserAccountDirector',
+                                                 'SimpleGetActivities')])
+        for activity in account.activities.values():
+            value = self.New(result, 'Activity')
+            value.AccountId = self.NewId(account.id)
+            value.Id = self.NewId(activity.id)
+            value.Name = activity.name
+            value.Type = activity.type
+            for roleType, deviceId, inputName in activity.roles:
+                role = self.New(value.Roles, 'AbstractActivityRole', roleType)
+                role.DeviceId = self.NewId(deviceId, 'DeviceId')
+                if inputName is not None:
+                    role.SelectedInput.Name = inputName
+                else:
+                    role.SelectedInput = None
+                self.Append(value.Roles, 'AbstractActivityRole', role)
+            self.Append(result, 'Activity', value)
+        return result
+
+    # RemoteManager
+
+    def SaveRemoteProperties(self, remoteId, remoteProperties):
+        account = self.household.FindAccount(remoteId=IdValue(remoteId))
+        if account is None:
+            raise Fault("Unknown remote %s" % Text(remoteId, 'Value'))
+        account.remoteName = Text(remoteProperties, 'RemoteName')
+        return "Successful"
+
+    # ProductsManager
+
+    def Product(self, skinId):
+        for product in PRODUCTS:
+            if str(product[0]) == skinId:
+                return product
+        raise Fault("Unknown skin %s" % skinId)
+
+    def GetProduct(self, skinId):
+        skinId, displayName, activityMapping = self.Product(Text(skinId))
+        result = self.CreateResult(self.methods[('ProductsManager',
+                                                 'GetProduct')])
+        result.SkinId = skinId
+        result.DisplayName = displayName
+        result.MaxDevicesPerAccount = 15
+        capabilities = ["CompiledRemoteButtonMapping"]
+        if activityMapping:
+            capabilities.append("ActivityCompiledRemoteButtonMapping")
+        for name in capabilities:
+            capability = self.New(result.SupportedCapabilities,
+                                  'ProductCapability')
+            capability.Name = name
+            self.Append(result.SupportedCapabilities, 'ProductCapability',
+                        capability)
+        return result
+
+    def GetProductButtonList(self, skinId):
+        self.Product(Text(skinId))
+        result = self.CreateResult(self.methods[('ProductsManager',
+                                                 'GetProductButtonList')])
+        for key in BUTTON_KEYS:
+            button = self.New(result.Buttons, 'ButtonDefinition')
+            button.ButtonKey = key
+            button.ButtonType = "Hard"
+            self.Append(result.Buttons, 'ButtonDefinition', button)
+        return result
+
+    def GetHarmonyProducts(self):
+        result = self.CreateResult(self.methods[('ProductsManager',
+                                                 'GetHarmonyProducts')])
+        for skinId, displayName, activityMapping in PRODUCTS:
+            product = self.New(result, 'HarmonyProduct')
+            product.SkinId = skinId
+            product.DisplayName = displayName
+            product.Name = displayName
+            self.Append(result, 'HarmonyProduct', product)
+        return result
+
+    # DeviceManager
+
+    def FillDevice(self, value, device):
+        value.Id = self.NewId(device.id)
+        value.Name = device.name
+        value.Manufacturer = device.manufacturer
+        value.Model = device.model
+        value.DeviceType = device.deviceType
+        value.InterKeyDelay = value.DefaultInterKeyDelay = 0
+        value.InterDeviceDelay = value.DefaultInterDeviceDelay = 0
+        return value
+
+    def GetDevices(self, deviceIds):
+        result = self.CreateResult(self.methods[('DeviceManager',
+                                                 'GetDevices')])
+        for device in self.Devices(deviceIds):
+            self.Append(result, 'Device',
+                        self.FillDevice(self.New(result, 'Device'), device))
+        return result
+
+    def GetDevice(self, deviceId):
+        return self.FillDevice(
+            self.CreateResult(self.methods[('DeviceManager', 'GetDevice')]),
+            self.FindDevice(deviceId))
+
+    def GetCommands(self, deviceIds):
+        result = self.CreateResult(self.methods[('DeviceManager',
+                                                 'GetCommands')])
+        name = 'KeyValueOfDeviceIdArrayOfCommand8_PSBnnKs'
+        for device in self.Devices(deviceIds):
+            entry = self.New(result, name)
+            entry.Key = self.NewId(device.id)
+            for command in device.commands:
+                value = self.New(entry.Value, 'Command')
+                value.Id = self.NewId(command.id)
+                value.FunctionId = self.NewId(command.id)
+                value.Name = command.name
+                value.IsLearned = str(command.isLearned).lower()
+                value.KeyCode = command.keyCode
+                self.Append(entry.Value, 'Command', value)
+            self.Append(result, name, entry)
+        return result
+
+    def SearchGlobalDevices(self, manufacturer, modelNumber, deviceType,
+                            searchType, maxResults):
+        manufacturer = (Text(manufacturer) or '').lower()
+        modelNumber = (Text(modelNumber) or '').lower()
+        maxResults = int(Text(maxResults) or 0)
+        result = self.CreateResult(self.methods[('DeviceManager',
+                                                 'SearchGlobalDevices')])
+        matches = 0
+        for i, (name, model) in enumerate(
+                (name, "%s-%d" % (letter, number))
+                for name in MANUFACTURERS for letter in "ABCDEFGH"
+                for number in range(100, 10000, 100)):
+            if matches >= maxResults:
+                break
+            if not name.lower().startswith(manufacturer) or \
+               not model.lower().startswith(modelNumber):
+                continue
+            match = self.New(result.Matches, 'PublicDeviceSearchMatch')
+            match.Manufacturer = name
+            match.DeviceModel = model
+            match.DeviceType = DEVICE_TYPES[i % len(DEVICE_TYPES)]
+            match.Id = self.NewId(i + 1)
+            self.Append(result.Matches, 'PublicDeviceSearchMatch', match)
+            matches += 1
+        result.Status = "Success"
+        return result
+
+    def UpdateMyData(self, operation):
+        self.ApplyOperation(operation)
+        return self.CreateResult(self.methods[('DeviceManager',
+                                               'UpdateMyData')])
+
+    def UpdateMultiple(self, operation):
+        result = self.CreateResult(self.methods[('DeviceManager',
+                                                 'UpdateMultiple')])
+        for item in Items(operation.getChild('Items')):
+            id = self.ApplyOperation(item)
+            entry = self.New(result, 'KeyValueOfanyTypeAbstractIdkS6NGDMp')
+            entry.Key = Text(item, 'ReturnIdAsKey') or str(uuid.uuid4())
+            entry.Value = self.NewId(id)
+            self.Append(result, 'KeyValueOfanyTypeAbstractIdkS6NGDMp', entry)
+        return result
+
+    # Applies a device manager operation and returns the id it affected.
+    def ApplyOperation(self, operation):
+        type = TypeName(operation)
+        if type == 'AddDeviceBySearchResultOperation':
+            account = self.FindAccount(operation.getChild('ParentAccount'))
+            match = operation.getChild('Match')
+            device = self.household.AddDevice(
+                account, Text(match, 'Manufacturer'),
+                Text(match, 'DeviceModel'), Text(match, 'DeviceType'))
+            device.name = Text(operation, 'DeviceName') or device.name
+            return device.id
+        device = self.FindDevice(operation.getChild('DeviceId') or
+                                 operation.getChild('Device').getChild('Id'))
+        if type == 'UpdateDeviceNameOperation':
+            device.name = Text(operation, 'DeviceName')
+        elif type == 'AddCommandOperation':
+            name = Text(operation, 'Name')
+            command = device.FindCommand(name=name)
+            if command is None:
+                command = Command(self.household.NextId(), name, True)
+                device.commands.append(command)
+            command.isLearned = True
+            command.keyCode = Text(operation, 'KeyCode')
+            return command.id
+        elif type == 'DeleteCommandOperation':
+            ids = operation.getChild('LanguageElementIds')
+            ids = set(int(node.getText()) for node in Items(ids))
+            device.commands = [command for command in device.commands
+                               if command.id not in ids]
+        elif type != 'UpdateUserDeviceOperation':
+            raise Fault("Unsupported operation %s" % type)
+        return device.id
+
+    # DeletionManager
+
+    def DeleteDevices(self, accountId, deviceIds):
+        for device in self.Devices(deviceIds):
+            self.household.RemoveDevice(device)
+
+    # InfraredAnalysisManager
+
+    def AnalyzeInfrared(self, deviceId, rawSequence):
+        method = self.methods[('InfraredAnalysisManager', 'AnalyzeInfrared')]
+        typeName, namespace = method.soap.output.body.parts[0].type
+        result = self.Create('{%s}SuccessAnalyzeInfraredResult' % namespace)
+        result.KeyCode = str(sum(map(ord, Text(rawSequence) or '')) %
+                             65536)
+        return result
+
+    # UserButtonMappingManager
+
+    def GetDeviceModeButtonMaps(self, deviceIds):
+        method = self.methods[('UserButtonMappingManager',
+                               'GetDeviceModeButtonMaps')]
+        entries = []
+        for device in self.Devices(deviceIds):
+            buttonMap = self.Create(self.ButtonMapType())
+            buttonMap.ButtonMapId = self.NewId(device.buttonMapId)
+            buttonMap.PrimaryDeviceReferenceId = self.NewId(device.id)
+            for key, assignment in device.buttons.items():
+                button = self.New(buttonMap.Buttons, 'AbstractButton',
+                                  'HardButton')
+                button.ButtonKey = key
+                if isinstance(assignment, int):
+                    button.ButtonAssignment = self.New(
+                        button, 'ButtonAssignment', 'CommandButtonAssignment')
+                    button.ButtonAssignment.CommandId = self.NewId(assignment)
+                else:
+                    button.ButtonAssignment = self.New(
+                        button, 'ButtonAssignment', 'ChannelButtonAssignment')
+                    button.ButtonAssignment.Channel = assignment
+                self.Append(buttonMap.Buttons, 'AbstractButton', button)
+            entry = Element('KeyValueOfDeviceIdButtonMap')
+            entry.append(self.Typed(method, 'Key', self.NewId(device.id)))
+            entry.append(self.Typed(method, 'Value', buttonMap))
+            entries.append(entry)
+        return entries
+
+    def ButtonMapType(self):
+        method = self.methods[('UserButtonMappingManager',
+                               'UpdateDeviceModeButtonMaps')]
+        typeName, namespace = method.soap.input.body.parts[0].type
+        return '{%s}ButtonMap' % namespace
+
+    def UpdateDeviceModeButtonMaps(self, buttonMaps):
+        for buttonMap in Items(buttonMaps):
+            mapId = IdValue(buttonMap, 'ButtonMapId')
+            devices = [device for device in self.household.devices.values()
+                       if device.buttonMapId == mapId]
+            if not devices:
+                raise Fault("Unknown button map %s" % mapId)
+            for button in Items(buttonMap.getChild('Buttons')):
+                key = Text(button, 'ButtonKey')
+                assignment = button.getChild('ButtonAssignment')
+                if assignment is None or \
+                   Text(button, 'ButtonAssignment') is None and \
+                   not assignment.getChildren():
+                    devices[0].buttons.pop(key, None)
+                elif TypeName(assignment) == 'ChannelButtonAssignment':
+                    devices[0].buttons[key] = Text(assignment, 'Channel')
+                else:
+                    devices[0].buttons[key] = IdValue(assignment, 'CommandId')
+
+    def DeleteTaughtDeviceModeCommandButtonMaps(self, deviceIds,
+                                                taughtCommandIds):
+        ids = set(int(node.getText()) for node in Items(taughtCommandIds))
+        for device in self.Devices(deviceIds):
+            for key, assignment in list(device.buttons.items()):
+                if assignment in ids:
+                    del device.buttons[key]
+
+    def GetButtonMaps(self, deviceIds, activityIds, remoteSkinId, accountId,
+                      surfaceId):
+        account = self.FindAccount(accountId)
+        result = self.CreateResult(self.methods[('UserButtonMappingManager',
+                                                 'GetButtonMaps')])
+        for device in self.Devices(deviceIds):
+            buttonMap = self.New(result, 'AbstractButtonMap',
+                                 'DeviceButtonMap')
+            buttonMap.ButtonMapId = self.NewId(device.buttonMapId)
+            buttonMap.DeviceId = self.NewId(device.id, 'DeviceId')
+            buttonMap.RemoteId = self.NewId(account.remoteId)
+            buttonMap.SurfaceId = self.NewId(account.surfaceId)
+            for key, commandName in device.userButtons.items():
+                button = self.New(buttonMap.Buttons, 'AbstractRemoteButton',
+                                  'HardRemoteButton')
+                button.ButtonKey = key
+                button.ButtonAction = self.New(button, 'ButtonAction',
+                                               'ButtonCommandAction')
+                button.ButtonAction.CommandName = commandName
+                button.ButtonAction.DeviceId = self.NewId(device.id,
+                                                          'DeviceId')
+                self.Append(buttonMap.Buttons, 'AbstractRemoteButton', button)
+            self.Append(result, 'AbstractButtonMap', buttonMap)
+        return result
+
+    def SaveButtonMaps(self, buttonMaps):
+        for buttonMap in Items(buttonMaps):
+            device = self.FindDevice(buttonMap.getChild('DeviceId'))
+            device.userButtons = {}
+            for button in Items(buttonMap.getChild('Buttons')):
+                commandName = Text(button, 'ButtonAction', 'CommandName')
+                if commandName is not None:
+                    device.userButtons[Text(button, 'ButtonKey')] = \
+                        commandName
+
+    def GetRemoteCanvas(self, remoteSkinId):
+        self.Product(Text(remoteSkinId))
+        result = self.CreateResult(self.methods[('UserButtonMappingManager',
+                                                 'GetRemoteCanvas')])
+        for key in BUTTON_KEYS:
+            button = self.New(result, 'AbstractRemoteButton',
+                              'HardRemoteButton')
+            button.ButtonKey = key
+            button.ButtonState = "Default"
+            button.FunctionGroupType = "Custom"
+            self.Append(result, 'AbstractRemoteButton', button)
+        return result
+
+    # UserFeatureManager
+
+    def GetUserFeatures(self, deviceIds):
+        result = self.CreateResult(self.methods[('UserFeatureManager',
+                                                 'GetUserFeatures')])
+        name = 'KeyValueOfDeviceIdArrayOfDeviceFeatureeiEyJu8p'
+        for device in self.Devices(deviceIds):
+            entry = self.New(result, name)
+            entry.Key = self.NewId(device.id)
+            power = self.New(entry.Value, 'DeviceFeature', 'PowerFeature')
+            self.Append(power.PowerToggleActions, 'AbstractIRAction',
+                        self.PressAction(power.PowerToggleActions, device))
+            power.PowerOnActions = None
+            power.PowerOffActions = None
+            self.Append(entry.Value, 'DeviceFeature', power)
+            if device.inputs:
+                feature = self.New(entry.Value, 'DeviceFeature',
+                                   'InputFeature')
+                feature.InputType = "Discrete"
+                for inputName in device.inputs:
+                    input = self.New(feature.Inputs, 'Input')
+                    input.InputName = inputName
+                    input.Actions = None
+                    self.Append(feature.Inputs, 'Input', input)
+                self.Append(entry.Value, 'DeviceFeature', feature)
+            self.Append(result, name, entry)
+        return result
+
+    def PressAction(self, actions, device):
+        action = self.New(actions, 'AbstractIRAction', 'IRPressAction')
+        action.IRCommandName = device.commands[0].name \
+            if device.commands else "PowerToggle"
+        action.Order = 1
+        return action
+
+    def SaveUserFeatures(self, deviceFeatures):
+        pass
+
+    # ActivityManager
+
+    def GetRecommendedActivitiesFromDevices(self, accountId,
+                                            devicesWithCapabilities):
+        result = self.CreateResult(self.methods[(
+            'ActivityManager', 'GetRecommendedActivitiesFromDevices')])
+        result.ActivityType = list(ACTIVITY_TYPES)
+        return result
+
+    def GetActivityRoles(self, accountId, activityTypes,
+                         devicesWithCapabilities):
+        result = self.CreateResult(self.methods[('ActivityManager',
+                                                 'GetActivityRoles')])
+        name = 'KeyValueOfActivityTypeRoleToDeviceMapping_SFvkcgrh'
+        mappingName = 'KeyValueOfAbstractActivityRoleArrayOfDeviceIdGQ_S527jd'
+        deviceIds = [IdValue(node, 'DeviceId')
+                     for node in Items(devicesWithCapabilities)]
+        for activityType in Items(activityTypes):
+            entry = self.New(result, name)
+            entry.Key = activityType.getText()
+            for roleType in ROLE_TYPES:
+                mapping = self.New(entry.Value.Mapping, mappingName)
+                mapping.Key = self.New(mapping, 'Key', roleType)
+                for deviceId in deviceIds:
+                    self.Append(mapping.Value, 'DeviceId',
+                                self.NewId(deviceId, 'DeviceId'))
+                self.Append(entry.Value.Mapping, mappingName, mapping)
+            self.Append(result, name, entry)
+        return result
+
+    def SaveActivities(self, accountId, activities):
+        account = self.FindAccount(accountId)
+        for node in Items(activities):
+            roles = [(TypeName(role), IdValue(role, 'DeviceId'),
+                      Text(role, 'SelectedInput', 'Name'))
+                     for role in Items(node.getChild('Roles'))]
+            activity = account.activities.get(IdValue(node, 'Id'))
+            if activity is None:
+                self.household.AddActivity(account, Text(node, 'Name'),
+                                           Text(node, 'Type'), roles)
+            else:
+                activity.name = Text(node, 'Name')
+                activity.roles = roles
+
+    def DeleteActivities(self, accountId, activityIds):
+        account = self.FindAccount(accountId)
+        for node in Items(activityIds):
+            account.activities.pop(IdValue(node), None)
+
+    # CompileManager
+
+    def StartCompileWithLocale(self, remoteId, locale):
+        compilationId = str(uuid.uuid4())
+        self.compilations[compilationId] = self.compilePolls
+        result = self.CreateResult(self.methods[('CompileManager',
+                                                 'StartCompileWithLocale')])
+        result.ApproximateSize = self.configSize
+        result.DownloadUrl = "https://svcs.myharmony.com" + COMPILE_PATH + \
+            "?CompilationId=" + compilationId
+        return result
+
+    # Returns the body of the reply to a config download poll, and whether
+    # the config was ready.
+    def PollConfig(self, body):
+        match = re.search(b'>([^<]*)<', body)
+        compilationId = match.group(1).decode('utf-8') if match else None
+        with self.household.lock:
+            if compilationId not in self.compilations:
+                raise Fault("Unknown compilation %s" % compilationId)
+            remaining = self.compilations[compilationId]
+            if remaining > 0:
+                self.compilations[compilationId] = remaining - 1
+                return (b"<RemoteConfiguration status='Pending'/>", False)
+            del self.compilations[compilationId]
+        config = bytes(i % 251 for i in range(self.configSize))
+        return (b"<RemoteConfiguration status='Successful' length='%d'/>" %
+                len(config) + config, True)
+
+def Fault500(message):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<s:Envelope xmlns:s="%s"><s:Body><s:Fault>'
+            '<faultcode>s:Server</faultcode><faultstring>%s</faultstring>'
+            '</s:Fault></s:Body></s:Envelope>' %
+            (envns[1], message)).encode('utf-8')
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.harmony.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # Counts the request (see HarmonyServer.Requests()) before replying, so
+    # that the counts are up to date as soon as the client has the reply.
+    def Send(self, status, body, contentType='text/xml; charset=utf-8',
+             headers=()):
+        self.server.harmony.Count(self.requestName, status >= 400)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.Dispatch(b'')
+
+    def do_POST(self):
+        self.Dispatch(self.rfile.read(int(self.headers.get('Content-Length')
+                                          or 0)))
+
+    def Dispatch(self, body):
+        harmony = self.server.harmony
+        path = urllib.parse.urlsplit(self.path).path
+        action = self.headers.get('SOAPAction')
+        operation = None
+        if action is not None:
+            operation = harmony.service.Operation(action)
+            name = '.'.join(operation) if operation else action
+        else:
+            name = path
+        self.requestName = name
+        failed = harmony.Simulate(name)
+        try:
+            if failed:
+                raise Fault("Simulated failure of " + name)
+            if action is not None:
+                if operation is None:
+                    raise Fault("Unknown operation " + name)
+                self.Send(200, harmony.service.Call(*(operation + (body,))))
+            elif path == COMPILE_PATH:
+                reply, ready = harmony.service.PollConfig(body)
+                headers = () if ready else [('Retry-After', '0.1')]
+                self.Send(200, reply, 'text/xml', headers)
+            elif path.endswith('/ProceedWithLIPLogin'):
+                tokens = {'id_token': uuid.uuid4().hex,
+                          'access_token': uuid.uuid4().hex}
+                self.Send(200, json.dumps(json.dumps(tokens)).encode('utf-8'),
+                          'application/json')
+            elif path.endswith('/TestMWLoginUser'):
+                self.Send(200, b'{"Result": false}', 'application/json')
+            elif path.endswith('/signin'):
+                self.Send(200, b'{"SignInResult": "Success"}',
+                          'application/json',
+                          [('Set-Cookie', 'SecurityToken=%s; Path=/' %
+                            uuid.uuid4().hex)])
+            elif path.endswith('/Account/Register'):
+                if self.command == 'POST':
+                    self.Send(302, b'', 'text/html',
+                              [('Location', '/MartiniWeb/Home')])
+                else:
+                    self.Send(200, self.RegisterPage(), 'text/html')
+            else:
+                self.Send(404, b'Not found', 'text/plain')
+        except Fault as error:
+            self.Send(500, Fault500(str(error)))
+        except Exception as error:
+            traceback.print_exc()
+            self.Send(500, Fault500("%s: %s" % (type(error).__name__, error)))
+
+    def RegisterPage(self):
+        options = ''.join('<option value="%s">%s</option>' % country
+                          for country in COUNTRIES)
+        return ('<html><body><form><select id="region" name="region">'
+                '<option value="">- Select Country -</option>%s</select>'
+                '</form></body></html>' % options).encode('utf-8')
+
+class ThreadedHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+# The server: a Service answering over HTTP on a background thread, with the
+# configured latency and failure rates.  Rates and latencies are given per
+# "Manager.Operation" (or request path, for the non-SOAP requests), falling
+# back to the defaults.
+class HarmonyServer:
+    def __init__(self, household=None, port=0, latency=0,
+                 operationLatency=None, failureRate=0,
+                 operationFailureRate=None, compilePolls=1, configSize=65536,
+                 seed=0, verbose=False):
+        self.service = Service(household or Household(seed=seed),
+                               compilePolls, configSize)
+        self.latency = latency
+        self.operationLatency = dict(operationLatency or {})
+        self.failureRate = failureRate
+        self.operationFailureRate = dict(operationFailureRate or {})
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.requests = {}          # name -> [requests, failures]
+        self.httpd = ThreadedHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.httpd.harmony = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.httpd.server_address[:2]
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # Sleeps for the configured latency and returns True if the request
+    # should fail.
+    def Simulate(self, name):
+        latency = self.operationLatency.get(name, self.latency)
+        with self.lock:
+            fail = self.random.random() < \
+                self.operationFailureRate.get(name, self.failureRate)
+        if latency:
+            time.sleep(latency)
+        return fail
+
+    def Count(self, name, failed):
+        with self.lock:
+            counts = self.requests.setdefault(name, [0, 0])
+            counts[0] += 1
+            if failed:
+                counts[1] += 1
+
+    def Requests(self):
+        with self.lock:
+            return dict((name, tuple(counts))
+                        for name, counts in self.requests.items())
+
+# ConnectionPool that connects to the local server whatever the host in the
+# URL.  It can be combined with the other pools, e.g.
+#   class LocalRecordingPool(LocalConnectionPool, RecordingConnectionPool)
+# records a session against the local server as if it were the real one.
+class LocalConnectionPool(ConnectionPool):
+    def __init__(self, url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        server = urllib.parse.urlsplit(url)
+        self.serverKey = ('http', server.hostname, server.port)
+        self.serverNetloc = server.netloc
+
+    def Destination(self, url):
+        parts = urllib.parse.urlsplit(url)
+        return urllib.parse.urlunsplit(('http', self.serverNetloc) +
+                                       tuple(parts[2:]))
+
+    def GetConnection(self, key, timeout):
+        return ConnectionPool.GetConnection(self, self.serverKey, timeout)
+
+    def ReleaseConnection(self, key, conn):
+        ConnectionPool.ReleaseConnection(self, self.serverKey, conn)
+
+def ParseRates(values):
+    rates = {}
+    for value in values or []:
+        name, _, rate = value.partition('=')
+        rates[name] = float(rate)
+    return rates
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the Harmony web services.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--accounts', type=int, default=1,
+                        help="accounts (remotes) in the household")
+    parser.add_argument('--devices', type=int, default=6,
+                        help="devices per account")
+    parser.add_argument('--commands', type=int, default=50,
+                        help="commands per device")
+    parser.add_argument('--activities', type=int, default=3,
+                        help="activities per account")
+    parser.add_argument('--inputs', type=int, default=4,
+                        help="inputs per device")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to every request")
+    parser.add_argument('--operation-latency', action='append',
+                        metavar='Manager.Operation=SECONDS')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="fraction of requests that fail")
+    parser.add_argument('--operation-failure-rate', action='append',
+                        metavar='Manager.Operation=RATE')
+    parser.add_argument('--compile-polls', type=int, default=1,
+                        help="config download polls answered with Pending")
+    parser.add_argument('--config-size', type=int, default=65536,
+                        help="size of the config file in bytes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    household = Household(args.accounts, args.devices, args.commands,
+                          args.activities, args.inputs, args.seed)
+    server = HarmonyServer(household, args.port, args.latency,
+                           ParseRates(args.operation_latency),
+                           args.failure_rate,
+                           ParseRates(args.operation_failure_rate),
+                           args.compile_polls, args.config_size, args.seed,
+                           args.verbose)
+    print("Serving on %s" % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
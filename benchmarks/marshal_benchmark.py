@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of MHPlugin.marshalled() over synthetic SaveButtonMaps-like
+# envelopes, compared with the original recursive implementation.
+#
+# Usage: python3 benchmarks/marshal_benchmark.py [buttons ...]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from suds.sax.element import Element
+from congruity.mhmanager import MHPlugin, XSI_NS, DATA_NS, \
+    USER_BUTTON_MAPPING_NS
+
+ENV_NS = ('SOAP-ENV', 'http://schemas.xmlsoap.org/soap/envelope/')
+XSI_INSTANCE_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+TEMPURI_NS = 'http://tempuri.org/'
+
+# The original list of types and recursive pass, for comparison.
+LEGACY_TYPES = [
+    (XSI_NS, "long"),
+    (DATA_NS, "DeviceId"),
+    (USER_BUTTON_MAPPING_NS, "ButtonCommandAction"),
+    (USER_BUTTON_MAPPING_NS, "HardRemoteButton"),
+    (USER_BUTTON_MAPPING_NS, "ActivityButtonMap"),
+    (USER_BUTTON_MAPPING_NS, "DeviceButtonMap"),
+]
+# Pad to the length of the real list so that membership tests cost the same.
+LEGACY_TYPES = [("urn:unused", str(i)) for i in range(33)] + LEGACY_TYPES
+
+class LegacyMHPlugin(MHPlugin):
+    def fix_elements(self, prefix, elements):
+        for element in elements:
+            if (element.get('type') is not None) and (element.name is not None):
+                ns = element.resolvePrefix(element.get('type').split(':')[0])[1]
+                type = element.get('type').split(':')[1]
+                if (ns, type) not in LEGACY_TYPES:
+                    element.unset('type')
+            if (element.prefix is None) and (prefix is not None):
+                element.setPrefix(prefix)
+            if element.getChildren() is not None:
+                self.fix_elements(element.prefix, element.getChildren())
+
+class Context:
+    def __init__(self, envelope):
+        self.envelope = envelope
+
+def typed(name, type, parent):
+    element = Element(name, parent)
+    element.set('xsi:type', type)
+    parent.append(element)
+    return element
+
+def text(name, value, parent, type=None):
+    element = Element(name, parent)
+    if type is not None:
+        element.set('xsi:type', type)
+    element.setText(value)
+    parent.append(element)
+    return element
+
+# Builds an envelope shaped like SaveButtonMaps with a userButtonMap holding
+# the given number of buttons.
+def BuildEnvelope(buttons):
+    envelope = Element('Envelope', ns=ENV_NS)
+    envelope.addPrefix('xsi', XSI_INSTANCE_NS)
+    envelope.addPrefix('ns0', TEMPURI_NS)
+    envelope.addPrefix('ns1', XSI_NS)
+    envelope.addPrefix('ns2', DATA_NS)
+    envelope.addPrefix('ns3', USER_BUTTON_MAPPING_NS)
+    body = Element('Body', ns=ENV_NS)
+    envelope.append(body)
+    operation = Element('SaveButtonMaps', ns=('ns0', TEMPURI_NS))
+    body.append(operation)
+    buttonMaps = Element('buttonMaps', operation)
+    operation.append(buttonMaps)
+    buttonMap = typed('ns3:AbstractButtonMap', 'ns3:DeviceButtonMap',
+                      buttonMaps)
+    deviceId = typed('DeviceId', 'ns2:DeviceId', buttonMap)
+    text('ns2:IsPersisted', 'true', deviceId, 'ns1:boolean')
+    text('ns2:Value', '12345678', deviceId, 'ns1:long')
+    container = Element('Buttons', buttonMap)
+    buttonMap.append(container)
+    for i in range(buttons):
+        button = typed('AbstractRemoteButton', 'ns3:HardRemoteButton',
+                       container)
+        action = typed('ButtonAction', 'ns3:ButtonCommandAction', button)
+        text('CommandName', 'Command%d' % i, action, 'ns1:string')
+        actionDeviceId = typed('DeviceId', 'ns2:DeviceId', action)
+        text('ns2:IsPersisted', 'true', actionDeviceId, 'ns1:boolean')
+        text('ns2:Value', '12345678', actionDeviceId, 'ns1:long')
+        text('EventType', '0', action, 'ns1:int')
+        text('FunctionId', str(1000 + i), action, 'ns1:long')
+        text('Order', '0', action, 'ns1:int')
+        text('ButtonKey', 'Key%d' % i, button, 'ns1:string')
+        text('ButtonState', 'Default', button, 'ns1:string')
+        text('FunctionGroupType', 'Custom', button, 'ns1:string')
+    return envelope
+
+def Run(plugin, template):
+    envelope = template.clone()
+    plugin.marshalled(Context(envelope))
+    return envelope
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+    legacy = LegacyMHPlugin()
+    current = MHPlugin()
+    print("%8s %12s %12s %8s" % ("buttons", "legacy (ms)", "current (ms)",
+                                 "speedup"))
+    for size in sizes:
+        template = BuildEnvelope(size)
+        if Run(legacy, template).str() != Run(current, template).str():
+            sys.exit("Output differs for %d buttons" % size)
+        number = max(1, 2000 // size)
+        # Subtract the cost of cloning the template, which both include.
+        clone = min(timeit.repeat(template.clone, number=number, repeat=3))
+        legacyTime = min(timeit.repeat(lambda: Run(legacy, template),
+                                       number=number, repeat=3)) - clone
+        currentTime = min(timeit.repeat(lambda: Run(current, template),
+                                        number=number, repeat=3)) - clone
+        print("%8d %12.3f %12.3f %7.2fx" % (
+            size, legacyTime * 1000 / number, currentTime * 1000 / number,
+            legacyTime / currentTime))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+# End-to-end benchmark of the main MHManager workflows.  Each workflow is run
+# a number of times against the local stand-in server (harmony_server.py),
+# a server that is already running, or a recorded session, and the p50/p95
+# latency, round trips and bytes transferred per run are written to a JSON
+# file, so that regressions can be spotted by comparing two runs.
+#
+# Usage: python3 benchmarks/workflow_benchmark.py [--iterations N]
+#            [--output FILE] [--server URL | --replay FILE] [--record FILE]
+#            [--latency SECONDS] [workflow ...]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from congruity.mhmanager import MHManager, ConnectionPool, \
+    RecordingConnectionPool, ReplayConnectionPool
+from harmony_server import HarmonyServer, Household, LocalConnectionPool
+
+# Synthetic IR commands for the GIRR import workflow, as (name, raw sequence).
+GIRR_COMMANDS = [("Girr%d" % i,
+                  " ".join("+%d -%d" % (560 + i, 1690 - i) for j in range(32)))
+                 for i in range(8)]
+
+class LocalRecordingPool(LocalConnectionPool, RecordingConnectionPool):
+    pass
+
+# ConnectionPool wrapper that counts the requests made through another pool
+# and the bytes sent and received.  Received bytes are taken from the
+# Content-Length of the responses, i.e. as they were on the wire.
+class CountingConnectionPool(ConnectionPool):
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def Retries(self):
+        return self.pool.Retries()
+
+    def Open(self, method, url, body=None, headers=None, timeout=None):
+        key, conn, response = self.pool.Open(method, url, body, headers,
+                                             timeout)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self.lock:
+            self.requests += 1
+            self.bytesSent += len(body or b'')
+            self.bytesReceived += int(response.getheader('Content-Length')
+                                      or 0)
+        return (key, conn, response)
+
+    def Release(self, key, conn, response):
+        self.pool.Release(key, conn, response)
+
+    def Destination(self, url):
+        return self.pool.Destination(url)
+
+    def Counts(self):
+        with self.lock:
+            return (self.requests, self.bytesSent, self.bytesReceived)
+
+    def Close(self):
+        self.pool.Close()
+
+class Context:
+    pass
+
+# The workflows.  Each is a function(mhMgr, context) doing what the GUI does
+# for one user action; setup that is not part of the action is done in
+# Setup().
+
+def Login(mhMgr, context):
+    mhMgr.Login(context.email, context.password)
+
+def Remotes(mhMgr, context):
+    mhMgr.InvalidateHousehold()
+    mhMgr.GetRemotes()
+
+def Devices(mhMgr, context):
+    mhMgr.GetDevices(context.remote.Id)
+
+def Commands(mhMgr, context):
+    mhMgr.Gather((mhMgr.GetProductButtonList, context.remote.SkinId),
+                 (mhMgr.GetButtonMap, context.device.Id),
+                 (mhMgr.GetCommands, context.device.Id))
+
+def ActivityTemplate(mhMgr, context):
+    mhMgr.GetActivityTemplate(context.remote.Id, "WatchTV")
+
+def GirrImport(mhMgr, context):
+    errors = mhMgr.UpdateIRCommands(GIRR_COMMANDS, context.device.Id)
+    if errors:
+        raise Exception(errors)
+
+def ConfigDownload(mhMgr, context):
+    mhMgr.GetConfig(context.remote, context.configFile)
+
+WORKFLOWS = [
+    ("login", Login),
+    ("remotes", Remotes),
+    ("devices", Devices),
+    ("commands", Commands),
+    ("activity-template", ActivityTemplate),
+    ("girr-import", GirrImport),
+    ("config-download", ConfigDownload),
+]
+
+def Setup(mhMgr, configFile):
+    context = Context()
+    context.email = "loadtest@example.com"
+    context.password = "password"
+    context.configFile = configFile
+    mhMgr.Login(context.email, context.password)
+    context.remote = mhMgr.GetRemotes()[0]
+    context.device = mhMgr.GetDevices(context.remote.Id)[0]
+    return context
+
+# Returns the pth percentile (nearest rank) of a sorted list.
+def Percentile(values, p):
+    index = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+def Run(mhMgr, pool, context, function, iterations, warmup):
+    for i in range(warmup):
+        function(mhMgr, context)
+    times = []
+    before = pool.Counts()
+    operationsBefore = mhMgr.GetOperationMetrics()
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(mhMgr, context)
+        times.append(time.perf_counter() - start)
+    after = pool.Counts()
+    operations = {}
+    for key, stats in mhMgr.GetOperationMetrics().items():
+        calls = stats['calls'] - operationsBefore.get(key, {}).get('calls', 0)
+        if calls:
+            operations[key] = calls / float(iterations)
+    times.sort()
+    return {
+        'iterations': iterations,
+        'p50': Percentile(times, 50),
+        'p95': Percentile(times, 95),
+        'mean': sum(times) / len(times),
+        'roundTrips': (after[0] - before[0]) / float(iterations),
+        'bytesSent': (after[1] - before[1]) / float(iterations),
+        'bytesReceived': (after[2] - before[2]) / float(iterations),
+        'operations': operations,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the main MHManager workflows.")
+    parser.add_argument('workflows', nargs='*', metavar='workflow',
+                        help="workflows to run (default: all of %s)" %
+                        ", ".join(name for name, function in WORKFLOWS))
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=1,
+                        help="untimed runs of each workflow first")
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help="file to write the results to")
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument('--server', metavar='URL',
+                         help="use an already running harmony_server.py")
+    backend.add_argument('--replay', metavar='FILE',
+                         help="replay a session recorded with --record")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record the session for later --replay")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="random extra latency, up to this many seconds "
+                        "(replay only)")
+    parser.add_argument('--devices', type=int, default=6,
+                        help="devices per account (local server only)")
+    parser.add_argument('--commands', type=int, default=50,
+                        help="commands per device (local server only)")
+    args = parser.parse_args()
+
+    workflows = [(name, function) for name, function in WORKFLOWS
+                 if not args.workflows or name in args.workflows]
+    unknown = set(args.workflows) - set(name for name, function in WORKFLOWS)
+    if unknown:
+        parser.error("unknown workflows: " + ", ".join(sorted(unknown)))
+    if args.replay and args.record:
+        parser.error("--record cannot be used with --replay")
+
+    server = None
+    if args.replay:
+        backend = 'replay:' + args.replay
+        pool = ReplayConnectionPool(args.replay, args.latency, args.jitter)
+    else:
+        url = args.server
+        if url is None:
+            server = HarmonyServer(Household(
+                devicesPerAccount=args.devices,
+                commandsPerDevice=args.commands), latency=args.latency).Start()
+            url = server.url
+        backend = url
+        if args.record:
+            pool = LocalRecordingPool(url, args.record)
+        else:
+            pool = LocalConnectionPool(url)
+    pool = CountingConnectionPool(pool)
+
+    results = {
+        'backend': backend,
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'workflows': {},
+    }
+    configFile = tempfile.NamedTemporaryFile(suffix='.EZHex', delete=False)
+    configFile.close()
+    # Use a product cache of our own, so that the stand-in server's products
+    # never end up in the user's cache and every run starts out the same.
+    cacheDirectory = tempfile.mkdtemp()
+    mhMgr = MHManager(True, pool=pool, product_cache=os.path.join(
+        cacheDirectory, 'products.sqlite'))
+    try:
+        context = Setup(mhMgr, configFile.name)
+        print("%-18s %10s %10s %8s %12s %12s" % (
+            "workflow", "p50 (ms)", "p95 (ms)", "trips", "sent (B)",
+            "recv (B)"))
+        for name, function in workflows:
+            result = Run(mhMgr, pool, context, function, args.iterations,
+                         args.warmup)
+            results['workflows'][name] = result
+            print("%-18s %10.1f %10.1f %8.1f %12.0f %12.0f" % (
+                name, result['p50'] * 1000, result['p95'] * 1000,
+                result['roundTrips'], result['bytesSent'],
+                result['bytesReceived']))
+    finally:
+        pool.Close()
+        if server is not None:
+            server.Stop()
+        os.unlink(configFile.name)
+        shutil.rmtree(cacheDirectory, ignore_errors=True)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+if __name__ == "__main__":
+    main()
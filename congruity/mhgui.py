@@ -43,11 +43,17 @@ try:
     from .mhmanager import MHAccountDetails
     from .mhmanager import SaveActivityTemplate
     from .mhmanager import Secrets
+    from .mhmanager import IdKey
+    from .mhmanager import RecordingConnectionPool
+    from .mhmanager import ReplayConnectionPool
 except (ImportError, ModuleNotFoundError):
     from mhmanager import MHManager
     from mhmanager import MHAccountDetails
     from mhmanager import SaveActivityTemplate
     from mhmanager import Secrets
+    from mhmanager import IdKey
+    from mhmanager import RecordingConnectionPool
+    from mhmanager import ReplayConnectionPool
 
 import xml.dom.minidom
 
@@ -57,6 +63,9 @@ HARMONY_350_SKIN_ID = "104"
 HARMONY_LINK_SKIN_ID = 82
 WATCH_TV_BUTTON_SKIN_IDS = [78, 79, 80, 81, 104]
 
+# Milliseconds to wait after the last keystroke before searching for devices.
+DEVICE_SEARCH_DELAY = 400
+
 try:
     import argparse
 except:
@@ -66,15 +75,36 @@ except:
     suds_debug = False
     if '--suds-debug' in sys.argv:
         suds_debug = True
+    trace_file = None
+    if '--trace-file' in sys.argv[:-1]:
+        trace_file = sys.argv[sys.argv.index('--trace-file') + 1]
+    record_session = None
+    if '--record-session' in sys.argv[:-1]:
+        record_session = sys.argv[sys.argv.index('--record-session') + 1]
+    replay_session = None
+    if '--replay-session' in sys.argv[:-1]:
+        replay_session = sys.argv[sys.argv.index('--replay-session') + 1]
 else:
     parser = argparse.ArgumentParser(description='Manage Logitech Harmony Remotes.')
     parser.add_argument('-d', '--suds-debug', help='output SOAP messages',
         action='store_true')
     parser.add_argument('-l', '--use-local-wsdl', help='use local wsdl file',
         action='store_true')
+    parser.add_argument('-t', '--trace-file', metavar='FILE',
+        help='append per-operation SOAP timings to FILE as JSON lines')
+    parser.add_argument('--record-session', metavar='FILE',
+        help='record all requests to the Harmony servers to FILE (session '
+        'cookies and login tokens are blanked out, but the file still holds '
+        'your account data)')
+    parser.add_argument('--replay-session', metavar='FILE',
+        help='answer requests from a --record-session FILE instead of the '
+        'Harmony servers')
     args = parser.parse_args()
     suds_debug = args.suds_debug
     use_local_wsdl = args.use_local_wsdl
+    trace_file = args.trace_file
+    record_session = args.record_session
+    replay_session = args.replay_session
 # This is initialized by initializeMHmgr(), called via BackgroundTask() by main()
 mhMgr = None
 
@@ -289,12 +319,21 @@ class WelcomePanel(WizardPanelBase):
     def IsCancelInitiallyDisabled(self):
         return False
 
-    def OnUserFetched(self, username, password):
+    def OnUserFetched(self, username, password, session=None):
         self.usernameCtrl.ChangeValue(username)
         self.passwordCtrl.ChangeValue(password)
         self.fetchedUsername = username
         self.fetchedPassword = password
         self.storeUserCtrl.SetValue(True)
+        # Skip the login if the session saved last time is still valid.
+        if session is not None:
+            BackgroundTask((mhMgr.RestoreSession, session, password),
+                           (self.FinishRestoreSession,), True, "Logging in...")
+
+    def FinishRestoreSession(self, restored):
+        if restored:
+            self.parent._SetPage(self.resources.page_remote_select, True,
+                                 True)
 
     def OnNext(self):
         username = self.usernameCtrl.GetValue()
@@ -317,9 +356,9 @@ class WelcomePanel(WizardPanelBase):
     def FinishLogin(self, loginResult):
         if loginResult is True:
             if secrets.HAVE_SECRET and self.storeUserCtrl.IsChecked():
-                if self.fetchedUsername != mhMgr.email or \
-                   self.fetchedPassword != mhMgr.password:
-                    secrets.storeUser(mhMgr.email, mhMgr.password)
+                # The session is new, so always store it.
+                secrets.storeUser(mhMgr.email, mhMgr.password,
+                                  session=mhMgr.SaveSession())
             self.parent._SetPage(self.next, True, True)
         else:
             if loginResult is None:
@@ -407,8 +446,9 @@ class RemoteSelectPanel(WizardPanelBase):
         self.LoadData()
 
     def LoadAddRemoteData(self):
-        self.supportedRemotes = mhMgr.GetSupportedRemoteNames()
-        self.supportedSkins = mhMgr.GetSupportedRemoteSkinIds()
+        catalog = mhMgr.GetProductCatalog()
+        self.supportedRemotes = catalog.remoteNames
+        self.supportedSkins = catalog.skinIds
 
     def LoadDataUI(self, loadDataResult):
         self.remotesListBox.Clear()
@@ -672,10 +712,15 @@ class RemoteConfigurationPanel(WizardPanelBase):
         self.rightButtonSizer.Add(self.setupActivitiesButton, 0, 0, 0)
 
     def LoadData(self):
-        self.product = mhMgr.GetProduct(self.remote.SkinId)
-        self.devices = mhMgr.GetDevices(self.remote.Id)
+        calls = [(mhMgr.GetProduct, self.remote.SkinId),
+                 (mhMgr.GetDevices, self.remote.Id)]
         if self.remote.SkinId == HARMONY_350_SKIN_ID:
-            self.watchTVActivity = mhMgr.GetActivity(self.remote.Id, "Watch TV")
+            calls.append((mhMgr.GetActivity, self.remote.Id, "Watch TV"))
+        results = mhMgr.Gather(*calls)
+        self.product = results[0]
+        self.devices = results[1]
+        if self.remote.SkinId == HARMONY_350_SKIN_ID:
+            self.watchTVActivity = results[2]
 
     def LoadDataUI(self, loadDataResult):
         self._msg_welcome = "Remote Configuration for " \
@@ -911,6 +956,7 @@ class AddDevicePanel(WizardPanelBase):
         self.manufacturerLabel = wx.StaticText(self, -1, "Manufacturer:")
         self.manufacturerCtrl = wx.TextCtrl(self, -1, "")
         self.manufacturerCtrl.SetMinSize((200, 31))
+        self.manufacturerCtrl.Bind(wx.EVT_TEXT, self.OnSearchText)
         self.manufacturerSizer = wx.BoxSizer(wx.HORIZONTAL)
         self.manufacturerSizer.Add(self.manufacturerLabel, 0, ALIGN_LCA, 0)
         self.manufacturerSizer.AddStretchSpacer()
@@ -919,6 +965,7 @@ class AddDevicePanel(WizardPanelBase):
         self.modelNumberText = wx.StaticText(self, -1, "Model Number:")
         self.modelNumberCtrl = wx.TextCtrl(self, -1, "")
         self.modelNumberCtrl.SetMinSize((200, 31))
+        self.modelNumberCtrl.Bind(wx.EVT_TEXT, self.OnSearchText)
         self.modelNumberSizer = wx.BoxSizer(wx.HORIZONTAL)
         self.modelNumberSizer.Add(self.modelNumberText, 0, ALIGN_LCA, 0)
         self.modelNumberSizer.AddStretchSpacer()
@@ -944,6 +991,12 @@ class AddDevicePanel(WizardPanelBase):
         self.SetSizerAndFit(self.sizer)
 
         self.next = None
+        self.matches = []
+        self.searchTimer = None
+        # Incremented for every search, so that the results of a search that
+        # has been superseded by a newer one can be ignored.
+        self.searchGeneration = 0
+        self.searchLock = threading.Lock()
 
     def OnActivated(self, prev_page, data):
         self.textMessage.UpdateText(self._msg_welcome)
@@ -952,7 +1005,32 @@ class AddDevicePanel(WizardPanelBase):
         self.ClearPage()
         return (None, None)
 
+    # Searches as the user types, once they have paused for
+    # DEVICE_SEARCH_DELAY milliseconds.
+    def OnSearchText(self, event):
+        if self.searchTimer is not None:
+            self.searchTimer.Stop()
+        self.searchGeneration += 1
+        if self.manufacturerCtrl.IsEmpty() or self.modelNumberCtrl.IsEmpty():
+            self.searchTimer = None
+            return
+        self.searchTimer = wx.CallLater(DEVICE_SEARCH_DELAY,
+                                        self.StartSearch, False)
+
+    def StartSearch(self, interactive):
+        self.searchTimer = None
+        self.searchGeneration += 1
+        manufacturer = self.manufacturerCtrl.GetValue()
+        modelNumber = self.modelNumberCtrl.GetValue()
+        BackgroundTask((self.DoSearch, manufacturer, modelNumber,
+                        self.searchGeneration),
+                       (self.FinishSearch, self.searchGeneration, interactive),
+                       True if interactive else None)
+
     def OnSearch(self, event):
+        if self.searchTimer is not None:
+            self.searchTimer.Stop()
+            self.searchTimer = None
         self.searchResultsList = []
         self.searchResultsListBox.Set(self.searchResultsList)
         if self.manufacturerCtrl.IsEmpty():
@@ -962,24 +1040,41 @@ class AddDevicePanel(WizardPanelBase):
             wx.MessageBox('Please enter a model number.',
                           'No model number entered.', wx.OK | wx.ICON_WARNING)
         else:
-            manufacturer = self.manufacturerCtrl.GetValue()
-            modelNumber = self.modelNumberCtrl.GetValue()
-            BackgroundTask((self.DoSearch, manufacturer, modelNumber),
-                           (self.FinishSearch,))
-
-    def DoSearch(self, manufacturer, modelNumber):
-        return mhMgr.SearchDevices(manufacturer, modelNumber, 5)
-
-    def FinishSearch(self, searchResults):
-        if searchResults.Status == "NoMatchFound":
-            wx.MessageBox('Sorry, no devices were found.',
-                          'No devices found.', wx.OK | wx.ICON_WARNING)
+            self.StartSearch(True)
+
+    # Searches run one at a time, and each on its own copy of the suds client
+    # (see MHManager.RunInWorker()), since they may overlap with other
+    # background tasks.  A search superseded while waiting is skipped.
+    def DoSearch(self, manufacturer, modelNumber, generation):
+        with self.searchLock:
+            if generation != self.searchGeneration:
+                return None
+            try:
+                return mhMgr.RunInWorker(mhMgr.SearchDevices, manufacturer,
+                                         modelNumber, 5)
+            except Exception as e:
+                return e
+
+    def FinishSearch(self, searchResults, generation, interactive):
+        # Ignore the results if another search has been started since.
+        if generation != self.searchGeneration:
+            return
+        self.matches = []
+        self.searchResultsList = []
+        if isinstance(searchResults, Exception):
+            if interactive:
+                wx.MessageBox('Device search failed: %s' % searchResults,
+                              'Search failed.', wx.OK | wx.ICON_WARNING)
+        elif searchResults.Status == "NoMatchFound":
+            if interactive:
+                wx.MessageBox('Sorry, no devices were found.',
+                              'No devices found.', wx.OK | wx.ICON_WARNING)
         else:
             self.matches = searchResults.Matches.PublicDeviceSearchMatch
             for match in self.matches:
                 self.searchResultsList.append(match.Manufacturer + " "
                                               + match.DeviceModel)
-            self.searchResultsListBox.Set(self.searchResultsList)
+        self.searchResultsListBox.Set(self.searchResultsList)
 
     def OnAdd(self, event):
         deviceToAdd = self.searchResultsListBox.GetSelections()
@@ -1305,6 +1400,12 @@ class ConfigureDevicePanel(WizardPanelBase):
                 "Remove overriden IR command/restore to official command"
         ))
         self.bottomSizer.Add(self.restoreButton, 0, 0, 0)
+        self.restoreAllButton = wx.Button(self, label="Restore All")
+        self.restoreAllButton.Bind(wx.EVT_BUTTON, self.OnRestoreAll)
+        self.restoreAllButton.SetToolTip(wx.ToolTip(
+                "Remove all overriden IR commands/restore to official commands"
+        ))
+        self.bottomSizer.Add(self.restoreAllButton, 0, 0, 0)
         self.girrButton = wx.Button(self, label="Import GIRR")
         self.girrButton.Bind(wx.EVT_BUTTON, self.OnGIRR)
         self.girrButton.SetToolTip(wx.ToolTip(
@@ -1375,13 +1476,33 @@ class ConfigureDevicePanel(WizardPanelBase):
         capabilities = mhMgr.GetCapabilityNames(self.product)
         if "CompiledRemoteButtonMapping" in capabilities:
             self.buttonMapType = "Compiled"
-            self.remoteButtons = mhMgr.GetProductButtonList(self.skinId)
-            self.buttonMap = mhMgr.GetButtonMap(self.deviceId)
+            self.remoteButtons, self.buttonMap, self.deviceCommands = \
+                mhMgr.Gather((mhMgr.GetProductButtonList, self.skinId),
+                             (mhMgr.GetButtonMap, self.deviceId),
+                             (mhMgr.GetCommands, self.deviceId))
         elif "ActivityCompiledRemoteButtonMapping" in capabilities:
             self.buttonMapType = "ActivityCompiled"
-            self.remoteButtons = mhMgr.GetRemoteCanvas(self.skinId)
-            self.buttonMap = mhMgr.GetUserButtonMap(self.deviceId)
-        self.deviceCommands = mhMgr.GetCommands(self.deviceId)
+            self.remoteButtons, self.buttonMap, self.deviceCommands = \
+                mhMgr.Gather((mhMgr.GetRemoteCanvas, self.skinId),
+                             (mhMgr.GetUserButtonMap, self.deviceId),
+                             (mhMgr.GetCommands, self.deviceId))
+            self.buttonMapEditor = mhMgr.EditUserButtonMap(self.buttonMap)
+        else:
+            self.deviceCommands = mhMgr.GetCommands(self.deviceId)
+
+    # Reloads the data after a change, which is needed even if the change
+    # failed part way.  Returns None on success, otherwise an error message.
+    def ReloadData(self):
+        try:
+            self.LoadData()
+        except Exception as e:
+            return str(e)
+        return None
+
+    def ShowReloadError(self, error):
+        if error is not None:
+            wx.MessageBox('Reloading the device data failed: ' + error,
+                          'Error', wx.OK | wx.ICON_WARNING)
 
     def LoadDataUI(self, loadDataResult):
         self.remoteButtonsListCtrl.DeleteAllItems()
@@ -1486,11 +1607,14 @@ class ConfigureDevicePanel(WizardPanelBase):
         BackgroundTask((self.DoUpdate, button, command), (self.LoadDataUI,))
 
     def DoUpdate(self, button, command):
+        # Only the button map changes, so don't reload everything.
         if self.buttonMapType == "Compiled":
             mhMgr.UpdateButtonMap(self.buttonMap, button, command)
+            self.buttonMap = mhMgr.GetButtonMap(self.deviceId)
         elif self.buttonMapType == "ActivityCompiled":
-            mhMgr.UpdateUserButtonMap(self.buttonMap, button, command)
-        self.LoadData()
+            # The editor updates self.buttonMap in place.
+            self.buttonMapEditor.Assign(button, command)
+            self.buttonMapEditor.Save()
 
     def OnOverride(self, event):
         commandSelection = self.deviceCommandsListCtrl.GetFirstSelected()
@@ -1574,6 +1698,38 @@ class ConfigureDevicePanel(WizardPanelBase):
                           wx.OK | wx.ICON_WARNING)
         self.LoadDataUI(None)
 
+    def OnRestoreAll(self, event):
+        commands = [command for command in self.deviceCommands
+                    if command.IsLearned == "true"]
+        if not commands:
+            wx.MessageBox('This device has no learned commands.',
+                          'Error', wx.OK | wx.ICON_WARNING)
+            return
+        with wx.MessageDialog(None,
+                              "Restore all %d learned commands?" % len(commands),
+                              "Restore All",
+                              wx.YES_NO | wx.ICON_QUESTION) as msgDialog:
+            if msgDialog.ShowModal() == wx.ID_YES:
+                BackgroundTask((self.DoRestoreAll, commands),
+                               (self.FinishRestoreAll,), True,
+                               "Restoring %d commands..." % len(commands))
+
+    def DoRestoreAll(self, commands):
+        try:
+            result = mhMgr.DeleteIRCommands(
+                [command.Id for command in commands], self.deviceId)
+        except Exception as e:
+            result = str(e)
+        return (result, self.ReloadData())
+
+    def FinishRestoreAll(self, results):
+        result, reloadError = results
+        if result is not None:
+            wx.MessageBox('IR command deletion failed: ' + result, 'Error',
+                          wx.OK | wx.ICON_WARNING)
+        self.ShowReloadError(reloadError)
+        self.LoadDataUI(None)
+
     # Validate the Pronto CCF string passed as command
     # Throw an exception if the CCF fails validation, otherwise return
     def ValidatePronto(self, command):
@@ -1677,12 +1833,18 @@ class ConfigureDevicePanel(WizardPanelBase):
                                "GIRR Import", msg,
                                wx.YES_NO | wx.ICON_QUESTION) as msgDialog:
                 if msgDialog.ShowModal() == wx.ID_YES:
-                    i = 1
+                    # Upload all of the commands at once rather than one at a
+                    # time.
+                    commands = []
                     for x in root.getElementsByTagName('command'):
-                        self.UpdateIRPronto(x.getAttribute('name'),
-                                       x.getElementsByTagName('ccf')[0].childNodes[0].data,
-                                       "Uploading %d of %d" % (i, commandcount))
-                        i += 1
+                        rawSequence = self.EncodePronto(
+                            x.getElementsByTagName('ccf')[0].childNodes[0].data)
+                        commands.append((x.getAttribute('name'),
+                                         rawSequence.value.decode('utf-8')))
+                        libconcord.delete_encoded_signal(rawSequence)
+                    BackgroundTask((self.DoUpdateIRCommands, commands),
+                                   (self.FinishUpdateIRCommands,), True,
+                                   "Uploading %d commands..." % commandcount)
                     return
         except:
             str = traceback.format_exc()
@@ -1696,14 +1858,6 @@ class ConfigureDevicePanel(WizardPanelBase):
         
     def UpdateIRPronto(self, commandName, command=None,
                        throbberTitle="Uploading IR Code..."):
-        # Based on LearnIrEnterProntoHexPanel._OnValidate(self, event) in
-        # congruity.py
-        # Because we are not learning IR and we are allocating the structures 
-        # for the IR signals (and Python should garbage collect them), we do not 
-        # init or deinit libconcord, nor do we call the libconcord functions to  
-        # allocate or free these structures. We only call into libconcord to
-        # encode the signal for posting.
-        #
         if command is None:
             dlg = wx.TextEntryDialog(None, "Enter the Pronto Hex code for the command:",
                                      "Pronto Hex")
@@ -1711,73 +1865,8 @@ class ConfigureDevicePanel(WizardPanelBase):
                 return
             command = dlg.GetValue()
         try:
-            bin = []
-            str = ""
-            str_idx = 0
-
-            hex = command.strip().split(' ')
-            for h in hex:
-                try:
-                    b = int(h, 16)
-                    bin.append(b)
-                except:
-                    raise Exception('The Pronto Code is not in a valid format. ' +
-                                    'Provide groups of 4 hex digits separated by spaces.')
-            if len(bin) < 4:
-                raise Exception('Pronto code too short (missing header)')
-
-            if bin[0] != 0:
-                raise Exception('Not RAW')
-
-            # If we choose to override the carrier frequency, we do not want to
-            # change the mark/space duration from the Pronto code. So we will
-            # use the embedded frequency always to calculate carrier_cycle_us.
-            # We can override the frequency later.
-            pronto_clock = 4145146
-            # IR carrier frequency is given as number of Pronto clock cycles
-            frequency = int(pronto_clock / bin[1])
-            # Mark/space durations are given as a count of IR carrier cycles,
-            # but we need them in microseconds
-            carrier_cycle_us = 1000000.0 / frequency
-
-            count_1 = 2 * bin[2]
-            count_2 = 2 * bin[3]
-
-            if len(bin) < 4 + count_1 + count_2:
-                raise Exception('Pronto code too short (missing pulsetrain)')
-
-            if len(bin) > 4 + count_1 + count_2:
-                raise Exception('Pronto code longer than header indicates')
-
-            start_1 = 4
-            start_2 = 4 + count_1
-
-            repeats = self.resources.prontoRepeats
-            count = count_1 + (repeats * count_2)
-            # Now we can override the frequency given that we have the correct
-            # carrier_cycle_us value.
-            if self.resources.prontoFrequencyOverride > 0 :
-                frequency = int(self.resources.prontoFrequencyOverride);
             self.commandName = commandName
-            self.carrierClock = ctypes.c_uint(frequency)
-            cur_ir_signal_type = ctypes.c_uint * count
-            self.signal = cur_ir_signal_type()
-            self.signalLength = ctypes.c_uint(count)
-
-            idx = 0
-
-            for i in range(count_1):
-                self.signal[idx] = int(bin[start_1 + i] * carrier_cycle_us)
-                idx += 1
-
-            for j in range(repeats):
-                for i in range(count_2):
-                    self.signal[idx] = int(bin[start_2 + i] * carrier_cycle_us)
-                    idx += 1
-
-            self.rawSequence = ctypes.c_char_p()
-            libconcord.encode_for_posting(self.carrierClock, self.signal,
-                                          self.signalLength, self.rawSequence)
+            self.rawSequence = self.EncodePronto(command)
             BackgroundTask((self.DoUpdateIR,), (self.FinishUpdateIRPronto,), True,
                    throbberTitle)
 
@@ -1786,6 +1875,86 @@ class ConfigureDevicePanel(WizardPanelBase):
             wx.MessageBox('Could not process Pronto: ' + exception_message(), 
                           'Error', wx.OK | wx.ICON_WARNING)                    
 
+    # Converts a Pronto Hex code to the encoded form that the web service
+    # expects, returned as a ctypes.c_char_p.  Raises an Exception if the code
+    # is not valid.
+    def EncodePronto(self, command):
+        # Based on LearnIrEnterProntoHexPanel._OnValidate(self, event) in
+        # congruity.py
+        # Because we are not learning IR and we are allocating the structures 
+        # for the IR signals (and Python should garbage collect them), we do not 
+        # init or deinit libconcord, nor do we call the libconcord functions to  
+        # allocate or free these structures. We only call into libconcord to
+        # encode the signal for posting.
+        #
+        bin = []
+        str = ""
+        str_idx = 0
+
+        hex = command.strip().split(' ')
+        for h in hex:
+            try:
+                b = int(h, 16)
+                bin.append(b)
+            except:
+                raise Exception('The Pronto Code is not in a valid format. ' +
+                                'Provide groups of 4 hex digits separated by spaces.')
+        if len(bin) < 4:
+            raise Exception('Pronto code too short (missing header)')
+
+        if bin[0] != 0:
+            raise Exception('Not RAW')
+
+        # If we choose to override the carrier frequency, we do not want to
+        # change the mark/space duration from the Pronto code. So we will
+        # use the embedded frequency always to calculate carrier_cycle_us.
+        # We can override the frequency later.
+        pronto_clock = 4145146
+        # IR carrier frequency is given as number of Pronto clock cycles
+        frequency = int(pronto_clock / bin[1])
+        # Mark/space durations are given as a count of IR carrier cycles,
+        # but we need them in microseconds
+        carrier_cycle_us = 1000000.0 / frequency
+
+        count_1 = 2 * bin[2]
+        count_2 = 2 * bin[3]
+
+        if len(bin) < 4 + count_1 + count_2:
+            raise Exception('Pronto code too short (missing pulsetrain)')
+
+        if len(bin) > 4 + count_1 + count_2:
+            raise Exception('Pronto code longer than header indicates')
+
+        start_1 = 4
+        start_2 = 4 + count_1
+
+        repeats = self.resources.prontoRepeats
+        count = count_1 + (repeats * count_2)
+        # Now we can override the frequency given that we have the correct
+        # carrier_cycle_us value.
+        if self.resources.prontoFrequencyOverride > 0 :
+            frequency = int(self.resources.prontoFrequencyOverride);
+        carrierClock = ctypes.c_uint(frequency)
+        cur_ir_signal_type = ctypes.c_uint * count
+        signal = cur_ir_signal_type()
+        signalLength = ctypes.c_uint(count)
+
+        idx = 0
+
+        for i in range(count_1):
+            signal[idx] = int(bin[start_1 + i] * carrier_cycle_us)
+            idx += 1
+
+        for j in range(repeats):
+            for i in range(count_2):
+                signal[idx] = int(bin[start_2 + i] * carrier_cycle_us)
+                idx += 1
+
+        rawSequence = ctypes.c_char_p()
+        libconcord.encode_for_posting(carrierClock, signal, signalLength,
+                                      rawSequence)
+        return rawSequence
+
     def UpdateIR(self, commandName):
         msg = 'Please ensure your remote control is connected.'
         wx.MessageBox(msg, 'Connect Remote', wx.OK)
@@ -1864,6 +2033,24 @@ class ConfigureDevicePanel(WizardPanelBase):
                           wx.OK | wx.ICON_WARNING)
         self.LoadDataUI(None)    
 
+    def DoUpdateIRCommands(self, commands):
+        try:
+            errors = mhMgr.UpdateIRCommands(commands, self.deviceId)
+        except Exception as e:
+            errors = dict((commandName, str(e))
+                          for commandName, rawSequence in commands)
+        return (errors, self.ReloadData())
+
+    def FinishUpdateIRCommands(self, results):
+        errors, reloadError = results
+        if errors:
+            msg = "The following commands could not be uploaded:\n\n"
+            for commandName, error in sorted(errors.items()):
+                msg += commandName + ": " + error + "\n"
+            wx.MessageBox(msg, 'Error', wx.OK | wx.ICON_WARNING)
+        self.ShowReloadError(reloadError)
+        self.LoadDataUI(None)
+
     def GetTitle(self):
         return "Device Configuration"
 
@@ -1885,7 +2072,10 @@ class FavoriteChannelsPanel(WizardPanelBase):
         "Then, type the channel on the right as you would enter it on your " +
         "remote.\n"
         + "If there is an existing channel assigned to a button, it\n"
-        + "will be displayed when you select the favorite control button."
+        + "will be displayed when you select the favorite control button.\n"
+        + "To program several buttons at once, enter channels separated by\n"
+        + "commas; they are assigned to the selected button and the ones\n"
+        + "following it."
     )
 
     def __init__(self, parent, resources):
@@ -1935,21 +2125,24 @@ class FavoriteChannelsPanel(WizardPanelBase):
         return (None, None)
 
     def LoadData(self):
-        self.remoteButtons = mhMgr.GetProductButtonList(self.skinId)
-        self.buttonMap = mhMgr.GetButtonMap(self.deviceId)
+        self.remoteButtons, self.buttonMap = \
+            mhMgr.Gather((mhMgr.GetProductButtonList, self.skinId),
+                         (mhMgr.GetButtonMap, self.deviceId))
 
     def LoadDataUI(self, loadDataResult):
         self.remoteButtonsList = []
+        self.favoriteButtons = []
         if self.remoteButtons is not None:
             for button in self.remoteButtons:
                 if button.ButtonType == "FavoriteChannelButton":
                     self.remoteButtonsList.append(button.ButtonKey)
+                    self.favoriteButtons.append(button)
             self.remoteButtonsListBox.Set(self.remoteButtonsList)
         self.Fit()
         self.parent.Show()
 
     def OnRemoteButtonSelection(self, event):
-        key = self.remoteButtons[self.remoteButtonsListBox.GetSelection()] \
+        key = self.favoriteButtons[self.remoteButtonsListBox.GetSelection()] \
             .ButtonKey
         foundCommand = self.FindCommand(key)
         if foundCommand is not None:
@@ -1970,18 +2163,26 @@ class FavoriteChannelsPanel(WizardPanelBase):
 
     def OnUpdate(self, event):
         buttonSelection = self.remoteButtonsListBox.GetSelection()
-        channel = self.channelCtrl.GetValue()
-        if (buttonSelection == -1) or (not channel.isdigit()):
+        channels = [channel.strip()
+                    for channel in self.channelCtrl.GetValue().split(',')]
+        if (buttonSelection == -1) or \
+           (not all(channel.isdigit() for channel in channels)):
             wx.MessageBox('Please select a button and channel to assign.',
                           'No selection(s) made.', wx.OK | wx.ICON_WARNING)
             return
-        button = self.remoteButtons[buttonSelection]
-        BackgroundTask((self.DoUpdate, button, channel), (self.LoadDataUI,))
+        buttons = self.favoriteButtons[buttonSelection:]
+        if len(channels) > len(buttons):
+            wx.MessageBox('There are only %d buttons from the selected button '
+                          'on.' % len(buttons), 'Too many channels.',
+                          wx.OK | wx.ICON_WARNING)
+            return
+        BackgroundTask((self.DoUpdate, list(zip(buttons, channels))),
+                       (self.LoadDataUI,))
 
-    def DoUpdate(self, button, channel):
-        mhMgr.UpdateButtonMap(self.buttonMap, button, channel,
-                              isChannelButton = True)
-        self.LoadData()
+    def DoUpdate(self, assignments):
+        mhMgr.UpdateButtonMaps(self.buttonMap, assignments,
+                               isChannelButton = True)
+        self.buttonMap = mhMgr.GetButtonMap(self.deviceId)
 
     def GetTitle(self):
         return "Favorite Channels"
@@ -2086,8 +2287,10 @@ class SetupWatchTVPanel(WizardPanelBase):
         self.devices = mhMgr.GetDevices(self.remote.Id)
         self.activity = mhMgr.GetWatchTVActivity(self.remote.Id)
         self.inputNames = {}
+        inputNames = mhMgr.GetDeviceInputNamesForDevices(
+            [device.Id for device in self.devices])
         for device in self.devices:
-            self.inputNames[device.Id] = mhMgr.GetDeviceInputNames(device.Id)
+            self.inputNames[device.Id] = inputNames.get(IdKey(device.Id))
 
     def LoadDataUI(self, loadDataResult):
         self.selectedDevicesListBox.Clear()
@@ -2543,9 +2746,9 @@ class SetupActivitiesPanel(WizardPanelBase):
         return (None, None)
 
     def LoadData(self):
-        self.activities = mhMgr.GetActivities(self.remote.Id)
-        self.recommendedActivities = mhMgr.GetRecommendedActivities(
-            self.remote.Id)
+        self.activities, self.recommendedActivities = \
+            mhMgr.Gather((mhMgr.GetActivities, self.remote.Id),
+                         (mhMgr.GetRecommendedActivities, self.remote.Id))
 
     def LoadDataUI(self, loadDataResult):
         self.activitiesListBox.Clear()
@@ -2833,8 +3036,9 @@ class AdjustPowerSettingsPanel(DevicePanelTemplate):
         return (None, None)
 
     def LoadData(self):
-        self.powerFeature = mhMgr.GetPowerFeature(self.device.Id)
-        self.deviceCommands = mhMgr.GetCommands(self.device.Id)
+        self.powerFeature, self.deviceCommands = \
+            mhMgr.Gather((mhMgr.GetPowerFeature, self.device.Id),
+                         (mhMgr.GetCommands, self.device.Id))
 
     def LoadDataUI(self, loadDataResult):
         self.deviceCommandsList = []
@@ -3017,8 +3221,9 @@ class AdjustDeviceDelaysPanel(DevicePanelTemplate):
         return (None, None)
 
     def LoadData(self):
-        self.device = mhMgr.GetDevice(self.deviceId)
-        self.userFeatures = mhMgr.GetUserFeatures(self.deviceId)
+        self.device, self.userFeatures = \
+            mhMgr.Gather((mhMgr.GetDevice, self.deviceId),
+                         (mhMgr.GetUserFeatures, self.deviceId))
 
     def LoadDataUI(self, loadDataResult):
         self.controlsSizer.Clear(True)
@@ -3335,18 +3540,28 @@ class Finalizer(object):
     def __call__(self):
         pass
 
+# Returns the connection pool to use for a recorded or replayed session, or
+# None for the default one.
+def createConnectionPool():
+    if replay_session:
+        return ReplayConnectionPool(replay_session)
+    if record_session:
+        return RecordingConnectionPool(record_session)
+    return None
+
 def initializeMHmgr():
     global mhMgr, use_local_wsdl, suds_debug
 
-    # If the user did not specify to use the local WSDL, we'll try the internet one first
-    # We'll fallback to local if it did not succeed.
-    # If the user did specify to use the local WSDL, we'll fallback to local
+    # If the user did not specify to use the local WSDL, we load the internet
+    # one and the local one at the same time and use whichever is ready first.
+    # If that fails, we try the local WSDL on its own.
     if not use_local_wsdl:
         try:
-            mhMgr = MHManager(False, suds_debug)
+            mhMgr = MHManager(None, suds_debug, trace_file=trace_file,
+                              pool=createConnectionPool())
             return True
         except:        
-            # We tried the Internet WSDL and failed
+            # Neither WSDL could be loaded in time
             str = traceback.format_exc()
             dlg = wx.MessageDialog(
                 None,
@@ -3360,7 +3575,8 @@ def initializeMHmgr():
             use_local_wsdl = True
     if use_local_wsdl:
         try:
-            mhMgr = MHManager(True, suds_debug)
+            mhMgr = MHManager(True, suds_debug, trace_file=trace_file,
+                              pool=createConnectionPool())
             return True
         except:        
             # We tried the Local WSDL and failed, show exception and exit.     
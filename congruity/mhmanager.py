@@ -20,6 +20,15 @@ import logging
 import six.moves.http_client as http_client
 import six.moves.urllib as urllib
 import uuid
+import base64
+import copy
+import io
+import gzip
+import zlib
+import hashlib
+import shutil
+import types
+import sqlite3
 import re
 import time
 import os
@@ -27,12 +36,27 @@ import sys
 import random
 import datetime
 import json
-import html
+import codecs
+import threading
+import asyncio
+import functools
+import collections
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from six.moves.html_parser import HTMLParser
+from six.moves.http_cookiejar import Cookie, CookieJar
+import suds
 from suds.cache import ObjectCache
-from suds.client import Client
-from suds.plugin import MessagePlugin
+from suds.client import Client, Factory, ServiceSelector
+from suds.options import Options
+from suds.properties import Unskin
+from suds.transport.https import HttpAuthenticated
+from suds.plugin import MessagePlugin, PluginContainer
+from suds.reader import DefinitionsReader
+from suds.servicedefinition import ServiceDefinition
+from suds.sudsobject import Object
+from suds.wsdl import Definitions
 
 try:
     import gi
@@ -55,7 +79,7 @@ ARRAYS_NS = "http://schemas.microsoft.com/2003/10/Serialization/Arrays"
 USER_FEATURE_NS = "http://schemas.datacontract.org/2004/07/Logitech.Harmony.Services.DataContract.UserFeature"
 USER_BUTTON_MAPPING_NS = "http://schemas.datacontract.org/2004/07/Logitech.Harmony.Services.DataContract.UserButtonMapping"
 
-TYPES_FOR_WHICH_TO_INCLUDE_TYPE_ENCODING = [
+TYPES_FOR_WHICH_TO_INCLUDE_TYPE_ENCODING = frozenset([
     (XSI_NS, "long"),
     (MS_NS, "guid"),
     (DATA_NS, "ActivityId"),
@@ -94,7 +118,88 @@ TYPES_FOR_WHICH_TO_INCLUDE_TYPE_ENCODING = [
     (USER_BUTTON_MAPPING_NS, "SoftRemoteButton"),
     (USER_BUTTON_MAPPING_NS, "ActivityButtonMap"),
     (USER_BUTTON_MAPPING_NS, "DeviceButtonMap"),
-]
+])
+
+# Number of seconds for which the result of GetMyHousehold is reused before
+# it is fetched again from the web service.
+HOUSEHOLD_CACHE_TTL = 300
+
+# Maximum number of device ids sent in a single bulk request.
+MAX_DEVICES_PER_REQUEST = 25
+
+# Maximum number of operations sent in a single UpdateMultiple OperationBag.
+MAX_OPERATIONS_PER_BAG = 25
+
+# A saved login session (see MHManager.SaveSession()) is used for at most this
+# many seconds, or until the first of its cookies expires if that is sooner.
+# Bump the version to discard existing saved sessions.
+SESSION_TTL = 12 * 60 * 60
+SESSION_VERSION = 1
+
+# The attributes of a Cookie saved with a session, in constructor order.
+SESSION_COOKIE_ATTRIBUTES = ('version', 'name', 'value', 'port',
+    'port_specified', 'domain', 'domain_specified', 'domain_initial_dot',
+    'path', 'path_specified', 'secure', 'expires', 'discard', 'comment',
+    'comment_url', '_rest', 'rfc2109')
+
+REMOTE_WSDL_URL = 'https://congruity.sourceforge.io/congruity/harmony.wsdl'
+
+# Number of seconds to wait for either the remote or the bundled WSDL to load
+# when loading both at the same time.
+WSDL_LOAD_DEADLINE = 30
+
+# Bump this to discard existing parsed WSDL snapshots, e.g. if the way they
+# are stored changes.
+WSDL_CACHE_VERSION = 1
+
+# Product definitions, button lists and remote canvases are kept in the
+# on-disk product cache for this many seconds.  Bump the version to discard
+# the existing entries.
+PRODUCT_CACHE_TTL = 7 * 24 * 60 * 60
+PRODUCT_CACHE_VERSION = 2
+
+# The country list for the account forms is kept on disk for this many
+# seconds.  Bump the version to discard the existing list.
+COUNTRY_LIST_CACHE_TTL = 30 * 24 * 60 * 60
+COUNTRY_LIST_CACHE_VERSION = 2
+COUNTRY_LIST_CHUNK_SIZE = 16384
+
+# Number of SearchDevices() results kept in memory, least recently used first
+# out.
+DEVICE_SEARCH_CACHE_SIZE = 64
+
+# Maximum number of idle keep-alive connections kept per host.
+MAX_IDLE_CONNECTIONS_PER_HOST = 4
+
+# HTTP methods that ConnectionPool may safely resend after any failure on a
+# reused connection.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS',
+                                'TRACE'])
+
+# Maximum number of worker threads used by MHManager.Gather().
+MAX_GATHER_WORKERS = 4
+
+# Size of the thread pool shared by all AsyncMHManager instances, and the
+# default number of requests each instance may have in flight at once.
+ASYNC_POOL_WORKERS = 32
+MAX_ASYNC_CONCURRENCY = 8
+
+# GetConfig polls the compile server for the finished configuration, first
+# after CONFIG_POLL_INITIAL_DELAY seconds and then with the delay growing by
+# CONFIG_POLL_BACKOFF up to CONFIG_POLL_MAX_DELAY, for CONFIG_POLL_TIMEOUT
+# seconds in total.  A Retry-After header from the server overrides the delay.
+CONFIG_POLL_INITIAL_DELAY = 0.5
+CONFIG_POLL_BACKOFF = 1.5
+CONFIG_POLL_MAX_DELAY = 8
+CONFIG_POLL_TIMEOUT = 60
+
+# The config file is streamed to disk in chunks of this many bytes.  The
+# status element must appear within the first CONFIG_STATUS_LIMIT bytes.
+CONFIG_CHUNK_SIZE = 65536
+CONFIG_STATUS_LIMIT = 65536
+CONFIG_STATUS_TAG = re.compile(b'<RemoteConfiguration[^>]*>')
+CONFIG_STATUS_SUCCESSFUL = re.compile(
+    b"<RemoteConfiguration status='Successful' length='([^']+)'/>")
 
 # This is a mapping between ActivityTypes and a friendly string
 ACTIVITY_TYPE_STRINGS = {
@@ -121,23 +226,662 @@ ROLE_STRINGS = {
     "VolumeActivityRole"              : "control volume",
 }
 
+# Returns a hashable key for a DeviceId/RemoteId/AccountId style object.
+def IdKey(id):
+    return (str(id.IsPersisted).lower(), str(id.Value))
+
+# suds returns a single object for an element that occurs once and a list
+# when it is repeated; this always returns a list.
+def AsList(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+# Returns the matches of a SearchGlobalDevices result as a list.
+def SearchMatches(result):
+    if result.Status == "NoMatchFound" or not result.Matches:
+        return []
+    return AsList(getattr(result.Matches, 'PublicDeviceSearchMatch', None))
+
+# Returns whether a device search match starts with the (lower case)
+# manufacturer and model number searched for.
+def PrefixMatch(match, manufacturer, modelNumber):
+    return (match.Manufacturer or '').lower().startswith(manufacturer) and \
+        (match.DeviceModel or '').lower().startswith(modelNumber)
+
+# Splits a list into lists of at most size items.
+def Chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Returns a copy of a suds object that shares its schema metadata but none of
+# its values.  This is much cheaper than copy.deepcopy(), which would also
+# copy the schema types the metadata refers to.
+def CopyObject(value):
+    if isinstance(value, list):
+        return [CopyObject(item) for item in value]
+    if not isinstance(value, Object):
+        return value
+    clone = value.__class__()
+    clone.__metadata__ = copy.copy(value.__metadata__)
+    for name, child in value:
+        setattr(clone, name, CopyObject(child))
+    return clone
+
+# Runs function(*args) on a new daemon thread and returns a Future for its
+# result.  Unlike a ThreadPoolExecutor thread, a daemon thread that is still
+# running (e.g. stuck on a slow connection) does not delay interpreter exit.
+def RunInDaemonThread(function, *args):
+    future = concurrent.futures.Future()
+    def Run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = function(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+    threading.Thread(target=Run, daemon=True).start()
+    return future
+
+# Returns the directory in which congruity keeps its caches, creating it if
+# necessary.
+def CacheDirectory(*subdirs):
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'congruity', *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# Returns a hash of the bundled WSDL and XSD files, the suds version and the
+# cache format, which identifies a parsed WSDL snapshot.
+def LocalWsdlHash():
+    directory = os.path.dirname(__file__)
+    digest = hashlib.sha256()
+    digest.update(('%d %s %s' % (WSDL_CACHE_VERSION, suds.__version__,
+                                 sys.version.split()[0])).encode('utf-8'))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.wsdl') or name.endswith('.xsd'):
+            digest.update(name.encode('utf-8'))
+            with open(os.path.join(directory, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:32]
+
+# Stores the fully parsed WSDL (suds cachingpolicy 1) for the bundled WSDL,
+# in a directory named after LocalWsdlHash() so that any change to the schema
+# files starts a new snapshot.  Older snapshots are removed.
+class WsdlSnapshotCache(ObjectCache):
+    def __init__(self):
+        parent = CacheDirectory('wsdl')
+        key = LocalWsdlHash()
+        for name in os.listdir(parent):
+            if name != key:
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+        ObjectCache.__init__(self, location=os.path.join(parent, key))
+
+    def get(self, id):
+        wsdl = ObjectCache.get(self, id)
+        # suds sets the options on every import of a cached WSDL, but imports
+        # of plain XSD documents have no imported object to set them on.
+        if wsdl is not None:
+            for imp in getattr(wsdl, 'imports', []):
+                if imp.imported is None:
+                    imp.imported = types.SimpleNamespace()
+        return wsdl
+
+# A suds client that builds its service definitions, which are only used to
+# print the client (str(client)), the first time they are needed.  suds
+# builds them on every start-up, which costs more than loading the WSDL
+# snapshot itself.  Otherwise the same as suds' Client.__init__().
+class LazyClient(Client):
+    def __init__(self, url, **kwargs):
+        options = Options()
+        options.transport = HttpAuthenticated()
+        self.options = options
+        if 'cache' not in kwargs:
+            kwargs['cache'] = ObjectCache(days=1)
+        self.set_options(**kwargs)
+        reader = DefinitionsReader(options, Definitions)
+        self.wsdl = reader.open(url)
+        plugins = PluginContainer(options.plugins)
+        plugins.init.initialized(wsdl=self.wsdl)
+        self.factory = Factory(self.wsdl)
+        self.service = ServiceSelector(self, self.wsdl.services)
+        self.messages = dict(tx=None, rx=None)
+
+    @property
+    def sd(self):
+        if self.__dict__.get('serviceDefinitions') is None:
+            self.serviceDefinitions = [ServiceDefinition(self.wsdl, s)
+                                       for s in self.wsdl.services]
+        return self.serviceDefinitions
+
+# Keeps HTTP(S) connections open between requests so that consecutive
+# requests to the same host do not each pay for a new TCP and TLS handshake.
+# Responses are requested with gzip/deflate encoding and decoded here.
+class ConnectionPool:
+    def __init__(self, maxIdlePerHost=MAX_IDLE_CONNECTIONS_PER_HOST):
+        self.maxIdlePerHost = maxIdlePerHost
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    # Returns the number of requests the current thread has had to resend on
+    # a fresh connection.
+    def Retries(self):
+        return getattr(self.local, 'retries', 0)
+
+    # Returns the URL that requests for url are actually sent to.  Caches of
+    # server replies include it, so that replies from different servers
+    # (e.g. a local stand-in) never mix.
+    def Destination(self, url):
+        return url
+
+    # Sends a request and returns (response, data), where response is the
+    # (fully read) http.client.HTTPResponse and data is the decoded body.
+    def Request(self, method, url, body=None, headers=None, timeout=None):
+        key, conn, response = self.Open(method, url, body, headers, timeout)
+        try:
+            data = response.read()
+        finally:
+            self.Release(key, conn, response)
+        return (response, self.Decode(response, data))
+
+    # Sends a request and returns (key, conn, response) with the response body
+    # still unread, for streaming.  The caller must pass all three to
+    # Release() when done.  The body is not decoded.
+    def Open(self, method, url, body=None, headers=None, timeout=None):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        headers = dict(headers or {})
+        if 'accept-encoding' not in [name.lower() for name in headers]:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        while True:
+            conn, reused = self.GetConnection(key, timeout)
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                return (key, conn, conn.getresponse())
+            except (http_client.HTTPException, ConnectionError) as e:
+                conn.close()
+                # The server may have closed an idle connection; retry on a
+                # fresh one.  A request that is not idempotent (e.g. a SOAP
+                # POST) may already have been acted on, so it is only resent
+                # if it could not be sent at all, or if the server closed the
+                # connection without replying.
+                if reused and (method.upper() in IDEMPOTENT_METHODS or
+                               not sent or
+                               isinstance(e, http_client.RemoteDisconnected)):
+                    self.local.retries = self.Retries() + 1
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+    # Returns the connection to the pool if the response was read completely,
+    # otherwise closes it.
+    def Release(self, key, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self.ReleaseConnection(key, conn)
+
+    def GetConnection(self, key, timeout):
+        with self.lock:
+            connections = self.idle.get(key)
+            conn = connections.pop() if connections else None
+        if conn is not None:
+            if isinstance(timeout, (int, float)):
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            return (conn, True)
+        scheme, host, port = key
+        if scheme == 'https':
+            connectionClass = http_client.HTTPSConnection
+        else:
+            connectionClass = http_client.HTTPConnection
+        if isinstance(timeout, (int, float)):
+            return (connectionClass(host, port, timeout=timeout), False)
+        return (connectionClass(host, port), False)
+
+    def ReleaseConnection(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.maxIdlePerHost:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def Decode(self, response, data):
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            data = gzip.decompress(data)
+        elif encoding == 'deflate':
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                # Some servers send raw deflate data without a zlib header.
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
+        else:
+            return data
+        # The body is no longer encoded; make sure nobody decodes it again.
+        del response.msg['Content-Encoding']
+        if response.msg['Content-Length'] is not None:
+            response.msg.replace_header('Content-Length', str(len(data)))
+        return data
+
+    def Close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+# urllib handler that sends http/https requests through a ConnectionPool.
+# Proxied requests are left to the standard handlers.
+class KeepAliveHandler(urllib.request.BaseHandler):
+    handler_order = 400
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def http_open(self, request):
+        if request.has_proxy():
+            return None
+        headers = dict(request.header_items())
+        response, data = self.pool.Request(request.get_method(),
+                                           request.full_url, request.data,
+                                           headers, request.timeout)
+        result = urllib.response.addinfourl(io.BytesIO(data), response.msg,
+                                            request.full_url, response.status)
+        result.msg = response.reason
+        return result
+
+    https_open = http_open
+
+# Returns whether requests for url have to go through a proxy (http_proxy,
+# https_proxy etc.).  ConnectionPool only makes direct connections.
+def UsesProxy(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme in urllib.request.getproxies() and \
+           not urllib.request.proxy_bypass(parts.hostname or '')
+
+# suds transport that uses a (shared) ConnectionPool and cookie jar, and
+# records every SOAP call in an OperationMetrics registry if given one.
+class KeepAliveTransport(HttpAuthenticated):
+    def __init__(self, pool=None, cookiejar=None, metrics=None, **kwargs):
+        HttpAuthenticated.__init__(self, **kwargs)
+        self.pool = pool if pool is not None else ConnectionPool()
+        if cookiejar is not None:
+            self.cookiejar = cookiejar
+        self.metrics = metrics
+
+    def u2handlers(self):
+        handlers = HttpAuthenticated.u2handlers(self)
+        handlers.append(KeepAliveHandler(self.pool))
+        return handlers
+
+    def send(self, request):
+        if self.metrics is None:
+            return HttpAuthenticated.send(self, request)
+        manager, operation = SoapOperation(request)
+        retries = self.pool.Retries()
+        start = time.monotonic()
+        reply = None
+        error = None
+        try:
+            reply = HttpAuthenticated.send(self, request)
+            return reply
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            responseBytes = 0
+            if reply is not None and reply.message is not None:
+                responseBytes = len(reply.message)
+            self.metrics.Record(manager, operation, time.monotonic() - start,
+                                len(request.message or b''), responseBytes,
+                                self.pool.Retries() - retries, error)
+
+# Returns the (manager, operation) names for a SOAP request, taken from its
+# SOAPAction, e.g. "http://tempuri.org/IDeviceManager/GetCommands" gives
+# ("DeviceManager", "GetCommands").
+def SoapOperation(request):
+    action = request.headers.get('SOAPAction') or ''
+    if isinstance(action, bytes):
+        action = action.decode('utf-8', 'replace')
+    parts = action.strip('"').rstrip('/').split('/')
+    if len(parts) < 2:
+        path = urllib.parse.urlsplit(request.url).path
+        return (path.rstrip('/').split('/')[-1] or 'Unknown', parts[-1])
+    manager = parts[-2]
+    if len(manager) > 1 and manager[0] == 'I' and manager[1].isupper():
+        manager = manager[1:]
+    return (manager, parts[-1])
+
+# Collects the wall time, request and response sizes, connection retries and
+# failures of SOAP calls, keyed by "Manager.Operation".  If traceFile is
+# given, each call is also appended to it as a line of JSON.
+class OperationMetrics:
+    def __init__(self, traceFile=None):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.trace = None
+        if traceFile is not None:
+            self.trace = open(traceFile, 'a', buffering=1)
+
+    def Record(self, manager, operation, seconds, requestBytes,
+               responseBytes, retries=0, error=None):
+        key = manager + '.' + operation
+        if error is not None:
+            code = getattr(error, 'httpcode', None)
+            error = ('HTTP %d' % code) if code is not None \
+                else type(error).__name__
+        with self.lock:
+            stats = self.operations.get(key)
+            if stats is None:
+                stats = self.operations[key] = dict(
+                    calls=0, failures=0, retries=0, totalTime=0.0,
+                    maxTime=0.0, requestBytes=0, responseBytes=0)
+            stats['calls'] += 1
+            stats['failures'] += error is not None
+            stats['retries'] += retries
+            stats['totalTime'] += seconds
+            stats['maxTime'] = max(stats['maxTime'], seconds)
+            stats['requestBytes'] += requestBytes
+            stats['responseBytes'] += responseBytes
+            if self.trace is not None:
+                self.trace.write(json.dumps(dict(
+                    time=time.time(), manager=manager, operation=operation,
+                    seconds=round(seconds, 6), requestBytes=requestBytes,
+                    responseBytes=responseBytes, retries=retries,
+                    error=error)) + '\n')
+
+    # Returns a copy of the statistics, optionally only for the given
+    # "Manager.Operation" key.
+    def Snapshot(self, key=None):
+        with self.lock:
+            if key is not None:
+                stats = self.operations.get(key)
+                return dict(stats) if stats is not None else None
+            return dict((key, dict(stats))
+                        for key, stats in self.operations.items())
+
+    # Returns the (key, stats) pairs with the highest total wall time first.
+    def Slowest(self, count=10):
+        return sorted(self.Snapshot().items(),
+                      key=lambda item: item[1]['totalTime'],
+                      reverse=True)[:count]
+
+    def Reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def Close(self):
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+
+# Returns the keys under which an exchange is recorded and looked up: an exact
+# one, and a loose one that ignores the body and the query string, which
+# contain random ids for some requests.  Only a hash of the body is kept so
+# that passwords don't end up in recordings.
+def ExchangeKeys(method, url, body, headers):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    exact = '%s %s %s' % (method, url, hashlib.sha256(body or b'').hexdigest())
+    action = ''
+    for name, value in (headers or {}).items():
+        if name.lower() == 'soapaction':
+            action = value.decode() if isinstance(value, bytes) else value
+    parts = urllib.parse.urlsplit(url)
+    loose = '%s %s://%s%s %s' % (method, parts.scheme, parts.netloc,
+                                 parts.path, action)
+    return (exact, loose)
+
+# Builds an http.client.HTTPResponse from a recorded exchange.  The body is
+# the one that was on the wire, so it is decoded by the pool as usual.
+def RecordedResponse(method, exchange):
+    body = base64.b64decode(exchange['body'])
+    lines = ['HTTP/1.1 %d %s' % (exchange['status'], exchange['reason'])]
+    for name, value in exchange['headers']:
+        if name.lower() not in ('transfer-encoding', 'content-length'):
+            lines.append('%s: %s' % (name, value))
+    lines.append('Content-Length: %d' % len(body))
+    data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+    response = http_client.HTTPResponse(RecordedSocket(data), method=method)
+    response.begin()
+    return response
+
+class RecordedSocket:
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode, *args, **kwargs):
+        return io.BytesIO(self.data)
+
+# Login tokens in (possibly double-encoded) JSON responses, and the value of
+# a Set-Cookie header.  These are blanked out in recordings, so that a
+# recording cannot be used to take over the session.
+RECORDED_TOKEN = re.compile(
+    rb'(\\?"(?:id_token|access_token|refresh_token)\\?"\s*:\s*\\?")[^"\\]*')
+RECORDED_COOKIE = re.compile(r'^([^=;]*=)[^;]*')
+
+# ConnectionPool that appends every exchange to a JSON-lines file for
+# ReplayConnectionPool.  Responses are read completely before they are
+# returned, so bodies are not streamed while recording.  Session cookies and
+# login tokens are replaced with "REDACTED".
+class RecordingConnectionPool(ConnectionPool):
+    def __init__(self, path, **kwargs):
+        ConnectionPool.__init__(self, **kwargs)
+        self.recording = open(path, 'a', buffering=1)
+        self.recordingLock = threading.Lock()
+
+    def Open(self, method, url, body=None, headers=None, timeout=None):
+        key, conn, response = ConnectionPool.Open(self, method, url, body,
+                                                  headers, timeout)
+        try:
+            data = response.read()
+        finally:
+            ConnectionPool.Release(self, key, conn, response)
+        # Only the login responses are JSON; they are stored decoded so that
+        # the tokens can be found.
+        if 'json' in (response.getheader('Content-Type') or ''):
+            data = RECORDED_TOKEN.sub(rb'\1REDACTED',
+                                      self.Decode(response, data))
+        recordedHeaders = []
+        for name, value in response.msg.items():
+            if name.lower() == 'set-cookie':
+                value = RECORDED_COOKIE.sub(r'\1REDACTED', value)
+            recordedHeaders.append((name, value))
+        exact, loose = ExchangeKeys(method, url, body, headers)
+        exchange = dict(exact=exact, loose=loose, status=response.status,
+                        reason=response.reason, headers=recordedHeaders,
+                        body=base64.b64encode(data).decode('ascii'))
+        with self.recordingLock:
+            self.recording.write(json.dumps(exchange) + '\n')
+        return (key, None, RecordedResponse(method, exchange))
+
+    def Release(self, key, conn, response):
+        pass
+
+    def Close(self):
+        ConnectionPool.Close(self)
+        with self.recordingLock:
+            self.recording.close()
+
+# ConnectionPool that answers requests from a RecordingConnectionPool file
+# instead of the network, after sleeping for latency seconds (plus up to
+# jitter seconds, drawn from a generator seeded with seed).  Repeated requests
+# get the recorded responses in order, and the last one once they run out.
+class ReplayConnectionPool(ConnectionPool):
+    def __init__(self, path, latency=0, jitter=0, seed=0, **kwargs):
+        ConnectionPool.__init__(self, **kwargs)
+        self.path = path
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.exchanges = {}
+        with open(path) as recording:
+            for line in recording:
+                if line.strip():
+                    exchange = json.loads(line)
+                    exchange['used'] = False
+                    for key in (exchange['exact'], exchange['loose']):
+                        self.exchanges.setdefault(key, []).append(exchange)
+
+    def Open(self, method, url, body=None, headers=None, timeout=None):
+        exchange = None
+        with self.lock:
+            for key in ExchangeKeys(method, url, body, headers):
+                candidates = self.exchanges.get(key)
+                if candidates:
+                    unused = [e for e in candidates if not e['used']]
+                    exchange = unused[0] if unused else candidates[-1]
+                    exchange['used'] = True
+                    break
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if exchange is None:
+            raise Exception("No recorded response for %s %s" % (method, url))
+        if delay > 0:
+            time.sleep(delay)
+        return (None, None, RecordedResponse(method, exchange))
+
+    def Release(self, key, conn, response):
+        pass
+
+    def Destination(self, url):
+        return 'replay:' + os.path.abspath(self.path) + ' ' + url
+
+# Returns the number of seconds given in a response's Retry-After header, or
+# None if there isn't one (or it is given as a date).
+def RetryAfter(response):
+    try:
+        return max(0, float(response.getheader('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+# Works out the delays between GetConfig polls (see CONFIG_POLL_*).
+class ConfigPollSchedule:
+    def __init__(self):
+        self.delay = CONFIG_POLL_INITIAL_DELAY
+        self.deadline = time.monotonic() + CONFIG_POLL_TIMEOUT
+
+    # Returns the number of seconds to wait before the next poll, or None if
+    # the time is up.  hint is the server's Retry-After value, if any.
+    def NextDelay(self, hint=None):
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        if hint is not None:
+            delay = min(hint, CONFIG_POLL_MAX_DELAY)
+        else:
+            delay = self.delay
+            self.delay = min(self.delay * CONFIG_POLL_BACKOFF,
+                             CONFIG_POLL_MAX_DELAY)
+        return min(delay, remaining)
+
+# Stores raw SOAP replies for the product operations, which depend only on
+# the skin id (and the server), in an SQLite database.  Replies rather than objects are stored
+# since suds objects can't be pickled; they are unmarshalled again on use.
+class ProductCache:
+    def __init__(self, path=None, ttl=PRODUCT_CACHE_TTL):
+        if path is None:
+            path = os.path.join(CacheDirectory(), 'products.sqlite')
+        self.path = path
+        self.ttl = ttl
+        db = self.Connect()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS replies ('
+                       'operation TEXT, skinId TEXT, version INTEGER, '
+                       'fetched REAL, reply BLOB, '
+                       'PRIMARY KEY (operation, skinId))')
+            db.commit()
+        finally:
+            db.close()
+
+    def Connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    # Returns the cached reply, or None if there is no current one.
+    def Get(self, operation, skinId):
+        db = self.Connect()
+        try:
+            row = db.execute('SELECT reply FROM replies WHERE operation = ? '
+                             'AND skinId = ? AND version = ? AND fetched > ?',
+                             (operation, str(skinId), PRODUCT_CACHE_VERSION,
+                              time.time() - self.ttl)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def Put(self, operation, skinId, reply):
+        db = self.Connect()
+        try:
+            db.execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?)',
+                       (operation, str(skinId), PRODUCT_CACHE_VERSION,
+                        time.time(), sqlite3.Binary(reply)))
+            db.commit()
+        finally:
+            db.close()
+
+    def Clear(self):
+        db = self.Connect()
+        try:
+            db.execute('DELETE FROM replies')
+            db.commit()
+        finally:
+            db.close()
+
 class MHPlugin(MessagePlugin):
+    def __init__(self):
+        # The last raw reply received on each thread.
+        self.replies = threading.local()
+    def received(self, context):
+        self.replies.last = context.reply
+    # Walks the tree iteratively, since large envelopes (e.g. SaveButtonMaps)
+    # have many elements.  Resolved type prefixes are remembered until an
+    # element that declares its own prefixes is reached.
     def fix_elements(self, prefix, elements):
-        for element in elements:
+        resolved = {}
+        stack = [(prefix, element, resolved) for element in reversed(elements)]
+        while stack:
+            prefix, element, resolved = stack.pop()
+            if element.nsprefixes:
+                resolved = {}
             # This is a bit odd, but the MH parser expects type="xxx" attributes
             # only for a few certain types.
-            if (element.get('type') is not None) and (element.name is not None):
-                ns = element.resolvePrefix(element.get('type').split(':')[0])[1]
-                type = element.get('type').split(':')[1]
+            typeName = element.get('type')
+            if (typeName is not None) and (element.name is not None):
+                typePrefix, _, type = typeName.partition(':')
+                if typePrefix in resolved:
+                    ns = resolved[typePrefix]
+                else:
+                    ns = element.resolvePrefix(typePrefix)[1]
+                    resolved[typePrefix] = ns
                 if (ns, type) not in TYPES_FOR_WHICH_TO_INCLUDE_TYPE_ENCODING:
                     element.unset('type')
             # Set the namespace prefix where it is set on the parent but not
             # on the children.
             if (element.prefix is None) and (prefix is not None):
                 element.setPrefix(prefix)
-            # Recursively fix the child elements.
-            if element.getChildren() is not None:
-                self.fix_elements(element.prefix, element.getChildren())
+            # Fix the child elements.
+            children = element.getChildren()
+            if children:
+                for child in reversed(children):
+                    stack.append((element.prefix, child, resolved))
     def marshalled(self, context):
         body = context.envelope.getChild('Body')
         # Make the namespace explicit in the operation tag vice having it
@@ -152,20 +896,221 @@ class MHPlugin(MessagePlugin):
         self.fix_elements(None, operation.getChildren())
 
 class MHManager():
-    def __init__(self, use_local_wsdl=False, suds_debug=False):
+    # If use_local_wsdl is None, the remote and the bundled WSDL are loaded at
+    # the same time (see LoadClientRacing).  product_cache is the path of the
+    # product cache database, True for the default one in the user's cache
+    # directory, or None to not cache products.
+    def __init__(self, use_local_wsdl=False, suds_debug=False,
+                 household_ttl=HOUSEHOLD_CACHE_TTL, trace_file=None,
+                 pool=None, product_cache=True):
+        if suds_debug:
+            logging.basicConfig(level=logging.INFO)
+            logging.getLogger('suds.transport').setLevel(logging.DEBUG)
+        self.metrics = OperationMetrics(trace_file)
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.cookiejar = CookieJar()
+        self.opener = urllib.request.build_opener(KeepAliveHandler(self.pool))
+        # For OpenUrl(): no redirect or error handling, like the pool.
+        self.proxyOpener = urllib.request.OpenerDirector()
+        for handler in (urllib.request.ProxyHandler(),
+                        urllib.request.HTTPHandler(),
+                        urllib.request.HTTPSHandler()):
+            self.proxyOpener.add_handler(handler)
+        self.plugin = MHPlugin()
+        self.productCache = None
+        if product_cache is not None:
+            try:
+                self.productCache = ProductCache(
+                    None if product_cache is True else product_cache)
+            except (OSError, sqlite3.Error):
+                pass
+        self.clientGeneration = 0
+        self.prototypes = {}
+        self.prototypesGeneration = 0
+        if use_local_wsdl is None:
+            self.sharedClient, remote = self.LoadClientRacing()
+            # Only once there is a shared client to compare against.
+            if remote is not None:
+                remote.add_done_callback(self.SwapInRemoteClient)
+        else:
+            self.sharedClient = self.CreateClient(use_local_wsdl)
+        self.workerState = threading.local()
+        self.executor = None
+        self.executorLock = threading.Lock()
+        self.householdLock = threading.RLock()
+        self.household = None
+        self.accountsById = {}
+        self.accountsByRemoteId = {}
+        self.accountsByDeviceId = {}
+        self.householdTtl = household_ttl
+        self.householdFetchTime = None
+        self.householdCacheHits = 0
+        self.householdCacheMisses = 0
+        self.productCatalog = None
+        self.searchCache = collections.OrderedDict()
+        self.searchCacheLock = threading.Lock()
+        self.searchCacheGeneration = 0
+
+    # Sends a request like ConnectionPool.Open(), except that requests that
+    # have to go through a proxy are sent with urllib instead.  Returns (key,
+    # conn, response); pass all three to ReleaseUrl() when done.
+    def OpenUrl(self, method, url, body=None, headers=None):
+        if not UsesProxy(url):
+            return self.pool.Open(method, url, body, headers)
+        request = urllib.request.Request(url, body, dict(headers or {}),
+                                         method=method)
+        return (None, None, self.proxyOpener.open(request))
+
+    def ReleaseUrl(self, key, conn, response):
+        if conn is None:
+            response.close()
+        else:
+            self.pool.Release(key, conn, response)
+
+    # Like ConnectionPool.Request(), but see OpenUrl().
+    def RequestUrl(self, method, url, body=None, headers=None):
+        key, conn, response = self.OpenUrl(method, url, body, headers)
+        try:
+            data = response.read()
+        finally:
+            self.ReleaseUrl(key, conn, response)
+        if conn is None:
+            return (response, data)
+        return (response, self.pool.Decode(response, data))
+
+    # Creates a suds client from either the bundled or the remote WSDL.
+    def CreateClient(self, use_local_wsdl):
         if use_local_wsdl:
             wsdl = os.path.join(os.path.dirname(__file__), 'harmony.wsdl')
             # pathlib automatically takes care of the differences when 
             # constructing a file URI on Windows vs. Linux/Mac
             url = Path(wsdl).as_uri()
-            cache = None
+            try:
+                cache = WsdlSnapshotCache()
+                cachingpolicy = 1
+            except OSError:
+                cache = None
+                cachingpolicy = 0
         else:
-            url = 'https://congruity.sourceforge.io/congruity/harmony.wsdl'
+            url = REMOTE_WSDL_URL
             cache = ObjectCache(hours=4)
-        if suds_debug:
-            logging.basicConfig(level=logging.INFO)
-            logging.getLogger('suds.transport').setLevel(logging.DEBUG)
-        self.client = Client(url, cache=cache, plugins=[MHPlugin()])
+            cachingpolicy = 0
+        return LazyClient(url, cache=cache, plugins=[self.plugin],
+                          transport=self.NewTransport(),
+                          cachingpolicy=cachingpolicy)
+
+    # Loads the remote and the bundled WSDL at the same time and returns
+    # (client, remote), where client is the one for whichever loads
+    # successfully first, within WSDL_LOAD_DEADLINE seconds.  If the bundled
+    # one wins, remote is the future for the remote one, which should be
+    # swapped in once it has loaded (see SwapInRemoteClient); otherwise it is
+    # None.  The loads run on daemon threads, so a remote load that is still
+    # going does not hold up exiting.
+    def LoadClientRacing(self):
+        remote = RunInDaemonThread(self.CreateClient, False)
+        local = RunInDaemonThread(self.CreateClient, True)
+        pending = set([remote, local])
+        deadline = time.monotonic() + WSDL_LOAD_DEADLINE
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=max(0, deadline - time.monotonic()),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                if future is local and remote in pending:
+                    return (future.result(), remote)
+                return (future.result(), None)
+        if error is not None:
+            raise error
+        raise Exception("Timed out loading the WSDL")
+
+    # Swaps in the remote client once it has loaded, if it turns out to be
+    # different from the bundled one.
+    def SwapInRemoteClient(self, future):
+        if future.exception() is not None:
+            return
+        client = future.result()
+        if str(client) != str(self.sharedClient):
+            self.sharedClient = client
+            self.clientGeneration += 1
+
+    # The suds client to use from the current thread: Gather() workers each
+    # have their own clone, everything else uses the shared client.
+    @property
+    def client(self):
+        return getattr(self.workerState, 'client', self.sharedClient)
+
+    # Runs function(*args, **kwargs) on a pool thread.  suds clients are not
+    # safe to use from several threads at once, so each pool thread gets its
+    # own clone that shares the login cookies with the main client.
+    def RunInWorker(self, function, *args, **kwargs):
+        if getattr(self.workerState, 'client', None) is None or \
+           self.workerState.generation != self.clientGeneration:
+            self.workerState.generation = self.clientGeneration
+            self.workerState.client = self.CloneClient()
+        return function(*args, **kwargs)
+
+    # Returns a suds transport that shares this manager's connection pool,
+    # login cookies and metrics.
+    def NewTransport(self):
+        return KeepAliveTransport(self.pool, self.cookiejar, self.metrics)
+
+    # Returns a copy of the shared client that shares its parsed WSDL and
+    # cookie jar but has its own options and transport.  (Client.clone()
+    # deep-copies the options, which fails with recent suds versions.)
+    def CloneClient(self):
+        client = copy.copy(self.sharedClient)
+        options = self.sharedClient.options
+        client.options = Options(**dict(
+            (name, getattr(options, name))
+            for name in Unskin(options).definitions if name != 'transport'))
+        client.options.transport = self.NewTransport()
+        client.service = ServiceSelector(client, client.wsdl.services)
+        client.messages = dict(tx=None, rx=None)
+        return client
+
+    # Returns a new instance of the named WSDL type.  client.factory.create()
+    # walks the schema every time, so the first instance of each type is kept
+    # as a prototype and later ones are copied from it.
+    def Create(self, typeName):
+        if self.prototypesGeneration != self.clientGeneration:
+            self.prototypes = {}
+            self.prototypesGeneration = self.clientGeneration
+        prototype = self.prototypes.get(typeName)
+        if prototype is None:
+            prototype = self.client.factory.create(typeName)
+            self.prototypes[typeName] = prototype
+        return CopyObject(prototype)
+
+    # Runs several independent calls concurrently and returns their results
+    # in the same order.  Each call is a tuple of (function, arg1, arg2, ...),
+    # e.g. mhMgr.Gather((mhMgr.GetProduct, skinId), (mhMgr.GetDevices, id)).
+    # If any call raises, the first exception is re-raised here, unless
+    # return_exceptions is True, in which case the exception is returned in
+    # place of that call's result.  The calls must not themselves use Gather().
+    def Gather(self, *calls, return_exceptions=False):
+        # Most calls look up accounts in the household, so make sure it is
+        # loaded before fanning out.
+        self.GetHousehold()
+        with self.executorLock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(MAX_GATHER_WORKERS)
+        futures = [self.executor.submit(self.RunInWorker, *call)
+                   for call in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
 
     # Log in to web service - returns True if login succeeded, False if login
     # failed, and None if the account appears to be a members.harmonyremote.com
@@ -176,13 +1121,13 @@ class MHManager():
         data = json.dumps({'email': email, 'password': password}).encode('utf-8')
         headers = {'Content-Type': 'application/json'}
         request = urllib.request.Request(url, data, headers)
-        response = urllib.request.urlopen(request)
+        response = self.opener.open(request)
         # For some reason the response to this is double-encoded
         jsonResponse = json.loads(json.loads(response.read().decode('utf-8')))
         if jsonResponse == 401:
             url = baseUrl + '/martiniweb/Home/TestMWLoginUser'
             request = urllib.request.Request(url, data, headers)
-            response = urllib.request.urlopen(request)
+            response = self.opener.open(request)
             jsonResponse = json.loads(response.read().decode('utf-8'))
             if jsonResponse["Result"]: # members.harmonyremote.com acct
                 return None
@@ -194,18 +1139,110 @@ class MHManager():
                            'access_token': jsonResponse['access_token']}).encode('utf-8')
         headers = {'Content-Type': 'application/json'}
         request = urllib.request.Request(url, data, headers)
-        response = urllib.request.urlopen(request)
+        response = self.opener.open(request)
         jsonResponse = json.loads(response.read().decode('utf-8'))
-        self.client.options.transport.cookiejar.extract_cookies(response,
-                                                                request)
+        self.cookiejar.extract_cookies(response, request)
 
         self.email = email
         self.password = password
+        self.loginTime = time.time()
+        self.InvalidateHousehold()
+        return True
+
+    # Returns the current login session (the cookies set by Login()) as a
+    # string that can be stored and passed to RestoreSession() later.
+    def SaveSession(self):
+        cookies = list(self.cookiejar)
+        expires = [cookie.expires for cookie in cookies if cookie.expires]
+        expires.append(self.loginTime + SESSION_TTL)
+        return json.dumps({
+            'version': SESSION_VERSION,
+            'email': self.email,
+            'loginTime': self.loginTime,
+            'expires': min(expires),
+            'cookies': [[getattr(cookie, name)
+                         for name in SESSION_COOKIE_ATTRIBUTES]
+                        for cookie in cookies],
+        })
+
+    # Logs in with a session saved by SaveSession() instead of going through
+    # Login().  The session is checked by fetching the household, which is
+    # needed next anyway.  Returns True if the session was still valid.
+    def RestoreSession(self, session, password=None):
+        try:
+            session = json.loads(session)
+            if session['version'] != SESSION_VERSION or \
+               session['expires'] <= time.time():
+                return False
+            for values in session['cookies']:
+                self.cookiejar.set_cookie(Cookie(*values))
+        except (ValueError, KeyError, TypeError):
+            self.cookiejar.clear()
+            return False
+        try:
+            self.GetHousehold(force=True)
+        except Exception:
+            self.cookiejar.clear()
+            self.InvalidateHousehold()
+            return False
+        self.email = session['email']
+        self.password = password
+        self.loginTime = session['loginTime']
         return True
 
-    # Gets the household info.
-    def GetHousehold(self):
-        self.household = self.client.service['AccountManager'].GetMyHousehold()
+    # Gets the household info.  The household is served from memory if it was
+    # fetched less than householdTtl seconds ago, unless force is True.
+    def GetHousehold(self, force=False):
+        with self.householdLock:
+            now = time.monotonic()
+            if not force and self.householdFetchTime is not None and \
+               now - self.householdFetchTime < self.householdTtl:
+                self.householdCacheHits += 1
+                return self.household
+            self.householdCacheMisses += 1
+            self.household = \
+                self.client.service['AccountManager'].GetMyHousehold()
+            self.householdFetchTime = now
+            self.IndexHousehold()
+            return self.household
+
+    # Builds the account lookup tables for the current household, keyed by
+    # IdKey() of the account, remote and device ids respectively.
+    # The tables are built before being assigned so that Gather() workers
+    # never see a partially built index.
+    def IndexHousehold(self):
+        accountsById = {}
+        accountsByRemoteId = {}
+        accountsByDeviceId = {}
+        try:
+            accounts = self.household.Accounts.Account
+        except AttributeError:
+            accounts = []
+        for account in accounts:
+            accountsById[IdKey(account.Id)] = account
+            if account.Remotes not in (None, ""):
+                for remote in account.Remotes.Remote:
+                    accountsByRemoteId[IdKey(remote.Id)] = account
+            if account.Devices not in (None, ""):
+                for device in account.Devices.Device:
+                    accountsByDeviceId[IdKey(device.Id)] = account
+        self.accountsById = accountsById
+        self.accountsByRemoteId = accountsByRemoteId
+        self.accountsByDeviceId = accountsByDeviceId
+
+    # Discards the cached household so the next GetHousehold() re-fetches it.
+    # Must be called after any operation that modifies the household.
+    def InvalidateHousehold(self):
+        self.householdFetchTime = None
+
+    # Returns a tuple of (hits, misses) for the household cache.
+    def GetHouseholdCacheStats(self):
+        return (self.householdCacheHits, self.householdCacheMisses)
+
+    # Returns the per-operation SOAP statistics (see OperationMetrics), e.g.
+    # GetOperationMetrics('DeviceManager.GetCommands')['totalTime'].
+    def GetOperationMetrics(self, key=None):
+        return self.metrics.Snapshot(key)
 
     # Gets the remote(s) for a given account.
     def GetRemotes(self):
@@ -221,10 +1258,7 @@ class MHManager():
         return remotes
 
     def GetRemoteForAccountId(self, accountId):
-        foundAccount = None
-        for account in self.household.Accounts.Account:
-            if account.Id.Value == accountId.Value:
-                foundAccount = account
+        foundAccount = self.accountsById.get(IdKey(accountId))
         try:
             return foundAccount.Remotes.Remote[0]
         except:
@@ -232,14 +1266,35 @@ class MHManager():
 
     # Gets the product info for a given Skin Id.
     def GetProduct(self, skinId):
-        return self.client.service['ProductsManager'].GetProduct(skinId)
+        return self.CallProductOperation('ProductsManager', 'GetProduct',
+                                         skinId)
 
     def GetProductButtonList(self, skinId):
-        return self.client.service['ProductsManager'].GetProductButtonList(skinId).Buttons.ButtonDefinition
+        return self.CallProductOperation('ProductsManager',
+                                         'GetProductButtonList',
+                                         skinId).Buttons.ButtonDefinition
 
     def GetRemoteCanvas(self, skinId):
-        return self.client.service['UserButtonMappingManager']. \
-            GetRemoteCanvas(skinId).AbstractRemoteButton
+        return self.CallProductOperation('UserButtonMappingManager',
+                                         'GetRemoteCanvas',
+                                         skinId).AbstractRemoteButton
+
+    # Calls an operation whose result depends only on the skin id, serving
+    # the reply from the product cache when there is a current one.
+    def CallProductOperation(self, manager, operation, skinId):
+        method = getattr(self.client.service[manager], operation)
+        if self.productCache is None:
+            return method(skinId)
+        key = '%s %s.%s' % (self.pool.Destination(method.method.location),
+                            manager, operation)
+        reply = self.productCache.Get(key, skinId)
+        if reply is not None:
+            return method(skinId, **{'__inject': {'reply': reply}})
+        self.plugin.replies.last = None
+        result = method(skinId)
+        if result is not None and self.plugin.replies.last is not None:
+            self.productCache.Put(key, skinId, self.plugin.replies.last)
+        return result
 
     def GetCapabilityNames(self, product):
         capabilityNames = []
@@ -248,7 +1303,7 @@ class MHManager():
         return capabilityNames
 
     def GetCommands(self, deviceId):
-        deviceIds = self.client.factory.create('{' + DATA_NS + '}deviceIds')
+        deviceIds = self.Create('{' + DATA_NS + '}deviceIds')
         deviceIds.DeviceId.append(deviceId)
         result = self.client.service['DeviceManager'].GetCommands(deviceIds)
         if result is not None:
@@ -257,7 +1312,7 @@ class MHManager():
             return None
 
     def GetButtonMap(self, deviceId):
-        deviceIds = self.client.factory.create('{' + DATA_NS + '}deviceIds')
+        deviceIds = self.Create('{' + DATA_NS + '}deviceIds')
         deviceIds.DeviceId.append(deviceId)
         result = self.client.service['UserButtonMappingManager'] \
             .GetDeviceModeButtonMaps(deviceIds)
@@ -266,38 +1321,78 @@ class MHManager():
         else:
             return None
 
+    # Returns a dictionary mapping IdKey(deviceId) to the commands for each of
+    # the given devices, using one GetCommands request per
+    # MAX_DEVICES_PER_REQUEST devices.
+    def GetCommandsForDevices(self, deviceIds):
+        commands = {}
+        for chunk in Chunks(list(deviceIds), MAX_DEVICES_PER_REQUEST):
+            ids = self.Create('{' + DATA_NS + '}deviceIds')
+            for deviceId in chunk:
+                ids.DeviceId.append(deviceId)
+            result = self.client.service['DeviceManager'].GetCommands(ids)
+            if result is not None:
+                for entry in AsList(result[0]):
+                    commands[IdKey(entry.Key)] = entry.Value[0]
+        return commands
+
+    # Returns a dictionary mapping IdKey(deviceId) to the button map for each
+    # of the given devices, using one GetDeviceModeButtonMaps request per
+    # MAX_DEVICES_PER_REQUEST devices.
+    def GetButtonMapsForDevices(self, deviceIds):
+        buttonMaps = {}
+        for chunk in Chunks(list(deviceIds), MAX_DEVICES_PER_REQUEST):
+            ids = self.Create('{' + DATA_NS + '}deviceIds')
+            for deviceId in chunk:
+                ids.DeviceId.append(deviceId)
+            result = self.client.service['UserButtonMappingManager'] \
+                .GetDeviceModeButtonMaps(ids)
+            if result is not None:
+                for entry in AsList(result[0]):
+                    buttonMaps[IdKey(entry.Key)] = entry.Value
+        return buttonMaps
+
     def UpdateButtonMap(self, existingButtonMap, button, command,
                         isChannelButton = False):
-        buttonMaps = self.client.factory.create('{' + BUTTON_MAPPING_NS
-                                                + '}buttonMaps')
-        buttonMap = self.client.factory.create('{' + BUTTON_MAPPING_NS
-                                               + '}ButtonMap')
+        self.UpdateButtonMaps(existingButtonMap, [(button, command)],
+                              isChannelButton)
+
+    # Assigns several buttons in one UpdateDeviceModeButtonMaps request.
+    # assignments is a list of (button, command), or of (button, channel) if
+    # isChannelButton is True.
+    def UpdateButtonMaps(self, existingButtonMap, assignments,
+                         isChannelButton = False):
+        buttonMaps = self.Create('{' + BUTTON_MAPPING_NS + '}buttonMaps')
+        buttonMap = self.Create('{' + BUTTON_MAPPING_NS + '}ButtonMap')
         # Have to do this because existingButtonMap doesn't have the correct
         # namespaces.  Same with the others below.
         buttonMap.ButtonMapId.IsPersisted = \
             existingButtonMap.ButtonMapId.IsPersisted
         buttonMap.ButtonMapId.Value = existingButtonMap.ButtonMapId.Value
         buttonMap.ButtonMapType = existingButtonMap.ButtonMapType
-        newButton = self.client.factory.create('{' + BUTTON_MAPPING_NS
-                                               + '}HardButton')
-        if isChannelButton is False:
-            newButton.ButtonAssignment = self.client.factory.create(
-                '{' + BUTTON_MAPPING_NS + '}CommandButtonAssignment')
-            newButton.ButtonAssignment.CommandId.IsPersisted = \
-                command.Id.IsPersisted
-            newButton.ButtonAssignment.CommandId.Value = command.Id.Value
-            newButton.ButtonAssignment.OverriddenDeviceId = None
-            newButton.ButtonAssignment.OverriddenButtonMapType = "NoSetting"
-        else:
-            newButton.ButtonAssignment = self.client.factory.create(
-                '{' + BUTTON_MAPPING_NS + '}ChannelButtonAssignment')
-            newButton.ButtonAssignment.Channel = command
-            newButton.ButtonAssignment.DeviceId.IsPersisted = \
-                existingButtonMap.PrimaryDeviceReferenceId.IsPersisted
-            newButton.ButtonAssignment.DeviceId.Value = \
-                existingButtonMap.PrimaryDeviceReferenceId.Value
-        newButton.ButtonKey = button.ButtonKey
-        buttonMap.Buttons.AbstractButton = newButton
+        newButtons = []
+        for button, command in assignments:
+            newButton = self.Create('{' + BUTTON_MAPPING_NS + '}HardButton')
+            if isChannelButton is False:
+                newButton.ButtonAssignment = self.Create(
+                    '{' + BUTTON_MAPPING_NS + '}CommandButtonAssignment')
+                newButton.ButtonAssignment.CommandId.IsPersisted = \
+                    command.Id.IsPersisted
+                newButton.ButtonAssignment.CommandId.Value = command.Id.Value
+                newButton.ButtonAssignment.OverriddenDeviceId = None
+                newButton.ButtonAssignment.OverriddenButtonMapType = \
+                    "NoSetting"
+            else:
+                newButton.ButtonAssignment = self.Create(
+                    '{' + BUTTON_MAPPING_NS + '}ChannelButtonAssignment')
+                newButton.ButtonAssignment.Channel = command
+                newButton.ButtonAssignment.DeviceId.IsPersisted = \
+                    existingButtonMap.PrimaryDeviceReferenceId.IsPersisted
+                newButton.ButtonAssignment.DeviceId.Value = \
+                    existingButtonMap.PrimaryDeviceReferenceId.Value
+            newButton.ButtonKey = button.ButtonKey
+            newButtons.append(newButton)
+        buttonMap.Buttons.AbstractButton = newButtons
         buttonMap.PrimaryDeviceReferenceId.IsPersisted = \
             existingButtonMap.PrimaryDeviceReferenceId.IsPersisted
         buttonMap.PrimaryDeviceReferenceId.Value = \
@@ -308,10 +1403,10 @@ class MHManager():
             .UpdateDeviceModeButtonMaps(buttonMaps)
 
     def GetUserButtonMap(self, deviceId):
-        DeviceId = self.client.factory.create('{' + DATA_NS + '}DeviceId')
+        DeviceId = self.Create('{' + DATA_NS + '}DeviceId')
         DeviceId.IsPersisted = deviceId.IsPersisted
         DeviceId.Value = deviceId.Value
-        deviceIds = self.client.factory.create('{' + DATA_NS + '}abstractIds')
+        deviceIds = self.Create('{' + DATA_NS + '}abstractIds')
         deviceIds.AbstractId.append(DeviceId)
         accountId = self.GetAccountIdForDevice(deviceId)
         remote = self.GetRemoteForAccountId(accountId)
@@ -320,58 +1415,36 @@ class MHManager():
             .GetButtonMaps(deviceIds, "", remote.SkinId, accountId,
                            surfaceId).AbstractButtonMap[0]
 
-    def UpdateUserButtonMap(self, userButtonMap, button, command):
-        accountId = self.GetAccountIdForDevice(userButtonMap.DeviceId)
-        remote = self.GetRemoteForAccountId(accountId)
-        surfaceId = remote.Surfaces.Surface[0].Id
-        userButtonMap.ButtonMapSurfaceId = surfaceId
-        userButtonMap.SurfaceId = surfaceId
-
-        # Check to see if there is an existing entry for this button
-        bmIndex = -1
-        for i in range(len(userButtonMap.Buttons.AbstractRemoteButton)):
-            try:
-                if userButtonMap.Buttons.AbstractRemoteButton[i].ButtonKey == \
-                   button.ButtonKey:
-                    bmIndex = i
-                    break
-            except AttributeError:
-                pass
-        if bmIndex != -1:
-            bmEntry = userButtonMap.Buttons.AbstractRemoteButton[i]
-        else:
-            bmEntry = self.client.factory.create('{' + USER_BUTTON_MAPPING_NS
-                                                + '}HardRemoteButton')
-            bmEntry.ButtonAction = self.client.factory.create('{' +
-                                                USER_BUTTON_MAPPING_NS
-                                                + '}ButtonCommandAction')
-        bmEntry.ButtonAction.EventType = 0
-        bmEntry.ButtonAction.Id = 0
-        bmEntry.ButtonAction.Order = 0
-        bmEntry.ButtonAction.CommandName = command.Name
-        bmEntry.ButtonAction.DeviceId = userButtonMap.DeviceId
-        bmEntry.ButtonAction.FunctionId = command.FunctionId
-        bmEntry.ButtonDoublePressAction = None
-        bmEntry.ButtonId = 0
-        bmEntry.ButtonLongPressAction = None
-        bmEntry.ButtonState = button.ButtonState
-        bmEntry.FunctionGroupType = button.FunctionGroupType
-        bmEntry.ButtonKey = button.ButtonKey
+    # Returns a UserButtonMapEditor for a map returned by GetUserButtonMap().
+    def EditUserButtonMap(self, userButtonMap):
+        return UserButtonMapEditor(self, userButtonMap)
 
-        if bmIndex != -1:
-            userButtonMap.Buttons.AbstractRemoteButton[bmIndex] = bmEntry
-        else:
-            userButtonMap.Buttons.AbstractRemoteButton.append(bmEntry)
-        buttonMaps = self.client.factory.create('{' + USER_BUTTON_MAPPING_NS
-                                                + '}ButtonMaps')
-        buttonMaps.AbstractButtonMap = userButtonMap
-        self.client.service['UserButtonMappingManager'] \
-            .SaveButtonMaps(buttonMaps)
+    def UpdateUserButtonMap(self, userButtonMap, button, command):
+        editor = self.EditUserButtonMap(userButtonMap)
+        editor.Assign(button, command)
+        editor.Save()
 
     # Get remote config file for the specified remote and write it to the
-    # specified filename.
-    def GetConfig(self, remote, filename):
-        remoteId = self.client.factory.create('{' + DATA_NS + '}Id')
+    # specified filename.  If given, progress(bytesWritten, totalBytes) is
+    # called as the file is downloaded; totalBytes may be None.
+    def GetConfig(self, remote, filename, progress=None):
+        compileRequest = self.StartCompile(remote)
+        schedule = ConfigPollSchedule()
+        while True:
+            done, retryAfter = self.PollConfig(compileRequest, filename,
+                                               progress)
+            if done:
+                return
+            # Give server time to respond.
+            delay = schedule.NextDelay(retryAfter)
+            if delay is None:
+                raise Exception("Failed to download config file")
+            time.sleep(delay)
+
+    # Starts compiling the config file for the specified remote.  Returns a
+    # (url, compilationIdString) tuple to be passed to PollConfig().
+    def StartCompile(self, remote):
+        remoteId = self.Create('{' + DATA_NS + '}Id')
         remoteId.IsPersisted = remote.Id.IsPersisted
         remoteId.Value = remote.Id.Value
 
@@ -381,49 +1454,65 @@ class MHManager():
         match = re.search('CompilationId=(.+)', compile.DownloadUrl)
         compilationId = match.group(1)
         compilationIdString = ('<string xmlns="http://schemas.microsoft.com/2003/10/Serialization/">' + compilationId + '</string>').encode('utf-8')
-        maxAttempts = 15
-        count = 0
-        while (count < maxAttempts):
-            newUrl = "https://" + url.netloc + url.path + "?" + str(uuid.uuid4())
-            httpRequest = urllib.request.Request(newUrl, compilationIdString,
-                                                 {"Content-Type": "text/xml"})
-            self.client.options.transport.cookiejar.add_cookie_header(
-                httpRequest)
-            fp = urllib.request.urlopen(httpRequest)
-            rawfile = fp.read()
-            response = rawfile.decode('ascii', 'ignore')
-            status = re.search(
-                '<RemoteConfiguration status=\'Successful\' length=\'.+\'/>',
-                response)
-            if status is not None:
-                file = rawfile[status.end():]
-                outputFile = open(filename, 'wb')
-                outputFile.write(file)
-                outputFile.close()
-                break
-            else:
-                # Give server time to respond.
-                time.sleep(4)
-                count += 1
-        if count == maxAttempts:
-            raise Exception("Failed to download config file")
+        return (url, compilationIdString)
+
+    # Asks the compile server once for the config file.  If it is ready, it
+    # is streamed to filename and (True, None) is returned; otherwise returns
+    # (False, retryAfter) where retryAfter is the server's suggested delay, if
+    # any.
+    def PollConfig(self, compileRequest, filename, progress=None):
+        url, compilationIdString = compileRequest
+        newUrl = "https://" + url.netloc + url.path + "?" + str(uuid.uuid4())
+        httpRequest = urllib.request.Request(newUrl, compilationIdString,
+                                             {"Content-Type": "text/xml"})
+        self.cookiejar.add_cookie_header(httpRequest)
+        headers = dict(httpRequest.header_items())
+        # The body is streamed as is, so don't ask for it compressed.
+        headers['Accept-Encoding'] = 'identity'
+        key, conn, response = self.OpenUrl("POST", newUrl,
+                                           compilationIdString, headers)
+        try:
+            if response.status != 200:
+                raise urllib.error.HTTPError(newUrl, response.status,
+                                             response.reason,
+                                             response.headers, None)
+            # Read just enough to see the status element.
+            prefix = b''
+            while len(prefix) < CONFIG_STATUS_LIMIT and \
+                  CONFIG_STATUS_TAG.search(prefix) is None:
+                chunk = response.read1(CONFIG_CHUNK_SIZE)
+                if not chunk:
+                    break
+                prefix += chunk
+            status = CONFIG_STATUS_SUCCESSFUL.search(prefix)
+            if status is None:
+                # Read the rest so that the connection can be reused.
+                response.read()
+                return (False, RetryAfter(response))
+            try:
+                total = int(status.group(1))
+            except ValueError:
+                total = None
+            written = 0
+            with open(filename, 'wb') as outputFile:
+                chunk = prefix[status.end():]
+                while chunk:
+                    outputFile.write(chunk)
+                    written += len(chunk)
+                    if progress is not None:
+                        progress(written, total)
+                    chunk = response.read(CONFIG_CHUNK_SIZE)
+            return (True, None)
+        finally:
+            self.ReleaseUrl(key, conn, response)
 
     def GetAccountForRemote(self, remoteId):
-        for account in self.household.Accounts.Account:
-            if account.Remotes != "":
-                for remote in account.Remotes.Remote:
-                    if (remote.Id.IsPersisted == remoteId.IsPersisted) and \
-                            (remote.Id.Value == remoteId.Value):
-                        return account
-        return None
+        return self.accountsByRemoteId.get(IdKey(remoteId))
 
     def GetAccountIdForDevice(self, deviceId):
-        for account in self.household.Accounts.Account:
-            if account.Devices != "":
-                for device in account.Devices.Device:
-                    if (device.Id.IsPersisted == deviceId.IsPersisted) and \
-                            (device.Id.Value == deviceId.Value):
-                        return account.Id
+        account = self.accountsByDeviceId.get(IdKey(deviceId))
+        if account is not None:
+            return account.Id
         return None
 
     def GetDevice(self, deviceId):
@@ -433,7 +1522,7 @@ class MHManager():
         self.GetHousehold()
         account = self.GetAccountForRemote(remoteId)
         if account.Devices != "":
-            deviceIds = self.client.factory.create('{' + DATA_NS + '}deviceIds')
+            deviceIds = self.Create('{' + DATA_NS + '}deviceIds')
             for device in account.Devices.Device:
                 deviceIds.DeviceId.append(device.Id)
             return self.client.service['DeviceManager'].GetDevices(
@@ -444,18 +1533,75 @@ class MHManager():
     def DeleteDevice(self, deviceId):
         self.GetHousehold()
         accountId = self.GetAccountIdForDevice(deviceId)
-        deviceIds = self.client.factory.create('{' + DATA_NS + '}deviceIds')
+        deviceIds = self.Create('{' + DATA_NS + '}deviceIds')
         deviceIds.DeviceId.append(deviceId)
-        return self.client.service['DeletionManager'].DeleteDevices(accountId,
-                                                                    deviceIds)
-
+        result = self.client.service['DeletionManager'].DeleteDevices(
+            accountId, deviceIds)
+        self.InvalidateHousehold()
+        return result
+
+    # Searches for devices.  Results are kept in an LRU cache (see
+    # DEVICE_SEARCH_CACHE_SIZE), and a search that refines a cached one (the
+    # same text with more characters typed) is answered from it when possible.
+    # The cache is emptied when a different client is swapped in.
     def SearchDevices(self, manufacturer, modelNumber, maxResults):
-        return self.client.service['DeviceManager'].SearchGlobalDevices(
-            manufacturer, modelNumber, "Unknown", "DidYouMeanMatch", maxResults)
+        key = (manufacturer.lower(), modelNumber.lower(), maxResults)
+        generation = self.clientGeneration
+        result = self.CachedSearch(*key)
+        if result is None:
+            result = self.client.service['DeviceManager'].SearchGlobalDevices(
+                manufacturer, modelNumber, "Unknown", "DidYouMeanMatch",
+                maxResults)
+            with self.searchCacheLock:
+                # Don't cache a reply from a client that has since been
+                # swapped out.
+                if self.searchCacheGeneration != generation:
+                    return CopyObject(result)
+                self.searchCache[key] = result
+                self.searchCache.move_to_end(key)
+                while len(self.searchCache) > DEVICE_SEARCH_CACHE_SIZE:
+                    self.searchCache.popitem(last=False)
+        return CopyObject(result)
+
+    # Returns the result of the given (lower case) search from the cache, or
+    # None.  A cached search for a prefix of both strings can answer a
+    # refinement if it returned fewer than its maxResults matches (so it has
+    # all of them) and all of them start with the strings searched for (so
+    # the server did not return any "did you mean" matches).
+    def CachedSearch(self, manufacturer, modelNumber, maxResults):
+        key = (manufacturer, modelNumber, maxResults)
+        with self.searchCacheLock:
+            if self.searchCacheGeneration != self.clientGeneration:
+                self.searchCache.clear()
+                self.searchCacheGeneration = self.clientGeneration
+            if key in self.searchCache:
+                self.searchCache.move_to_end(key)
+                return self.searchCache[key]
+            for (cachedManufacturer, cachedModel, cachedMax), cached in \
+                    reversed(self.searchCache.items()):
+                if not manufacturer.startswith(cachedManufacturer) or \
+                   not modelNumber.startswith(cachedModel):
+                    continue
+                matches = SearchMatches(cached)
+                if len(matches) >= cachedMax or \
+                   not all(PrefixMatch(match, cachedManufacturer, cachedModel)
+                           for match in matches):
+                    continue
+                matches = [match for match in matches
+                           if PrefixMatch(match, manufacturer, modelNumber)]
+                result = CopyObject(cached)
+                if matches:
+                    result.Matches.PublicDeviceSearchMatch = \
+                        matches[:maxResults]
+                else:
+                    result.Status = "NoMatchFound"
+                    result.Matches = None
+                return result
+        return None
 
     def AddDevice(self, device, remoteId):
         self.GetHousehold()
-        operation = self.client.factory.create(
+        operation = self.Create(
             '{' + DM_OPERATION_NS + '}AddDeviceBySearchResultOperation'
         )
         operation.ParentAccount = self.GetAccountForRemote(remoteId).Id
@@ -465,33 +1611,38 @@ class MHManager():
         operation.IsScartCableSupported = "false"
         operation.Match = device
         operation.PrivateAddTypeUsed = "NotApplicable"
-        return self.client.service['DeviceManager'].UpdateMyData(operation)
+        result = self.client.service['DeviceManager'].UpdateMyData(operation)
+        self.InvalidateHousehold()
+        return result
 
     def RenameDevice(self, deviceId, newName):
         self.GetHousehold()
-        operation = self.client.factory.create(
+        operation = self.Create(
             '{' + DM_OPERATION_NS + '}UpdateDeviceNameOperation'
         )
-        id = self.client.factory.create('{' + DATA_NS + '}Id')
+        id = self.Create('{' + DATA_NS + '}Id')
         id.IsPersisted = deviceId.IsPersisted
         id.Value = deviceId.Value
         operation.ParentAccount = self.GetAccountIdForDevice(deviceId)
         operation.DeviceId = id
         operation.DeviceName = newName
-        return self.client.service['DeviceManager'].UpdateMyData(operation)
+        result = self.client.service['DeviceManager'].UpdateMyData(operation)
+        self.InvalidateHousehold()
+        return result
 
     def UpdateDevice(self, device, remoteId):
-        operation = self.client.factory.create(
+        operation = self.Create(
             '{' + DM_OPERATION_NS + '}UpdateUserDeviceOperation'
         )
         operation.ParentAccount = self.GetAccountForRemote(remoteId).Id
         operation.Device = device
-        return self.client.service['DeviceManager'].UpdateMyData(operation)
+        result = self.client.service['DeviceManager'].UpdateMyData(operation)
+        self.InvalidateHousehold()
+        return result
 
     # Returns 'None' on success.  Otherwise returns a string with an error msg.
     # Parameter is an instance of MHAccountDetails.
     def CreateAccount(self, details):
-        host = "setup.myharmony.com"
         url = "https://setup.myharmony.com/MartiniWeb/Account/Register"
         params = urllib.parse.urlencode(
             {'FirstName': details.firstName, 'LastName': details.lastName,
@@ -499,13 +1650,10 @@ class MHManager():
              'region': details.country, 'Emailaddress': details.email,
              'Password': details.password, 'RetypePassword': details.password,
              'IsPolicyAccepted': 'true',
-             'Keepmeinformed': details.keepMeInformed})
+             'Keepmeinformed': details.keepMeInformed}).encode('utf-8')
         headers = {"Content-type": "application/x-www-form-urlencoded"}
-        conn = http_client.HTTPSConnection(host)
-        conn.request("POST", url, params, headers)
-        response = conn.getresponse()
-        data = response.read().decode('utf-8')
-        conn.close()
+        response, data = self.RequestUrl("POST", url, params, headers)
+        data = data.decode('utf-8')
         # We get a redirect response (code 302) on success.  Return.
         if response.status == 302:
             return None
@@ -542,8 +1690,7 @@ class MHManager():
             print("SecureControllerHandshake failed.")
             return False
 
-        properties = self.client.factory.create('{' + ACCOUNT_NS
-                                                + '}Properties')
+        properties = self.Create('{' + ACCOUNT_NS + '}Properties')
         properties.ContactMe = details.keepMeInformed
         properties.CountryType = details.country
         properties.Email = details.email
@@ -554,6 +1701,7 @@ class MHManager():
             self.household.Accounts.Account[0].Properties.UserKey
         result = self.client.service['AccountManager']. \
             UpdateMyAccountProperties(properties)
+        self.InvalidateHousehold()
         if result is not None:
             print("UpdateMyAccountProperties failed: " + str(result))
             return False
@@ -569,15 +1717,53 @@ class MHManager():
 
         return True
 
+    # Returns [country codes, country names] for the account forms.  These
+    # hardly ever change, so they are cached on disk (see COUNTRY_LIST_*).
     def GetCountryLists(self):
-        conn = http_client.HTTPSConnection("setup.myharmony.com")
-        conn.request("GET",
-                     "https://setup.myharmony.com/MartiniWeb/Account/Register")
-        response = conn.getresponse()
-        data = response.read().decode('utf-8')
-        parser = CountryListHTMLParser()
-        parser.feed(html.unescape(data))
-        return [parser.country_codes, parser.countries]
+        path = None
+        try:
+            path = os.path.join(CacheDirectory(), 'countries.json')
+            with open(path) as f:
+                cached = json.load(f)
+            if cached['version'] == COUNTRY_LIST_CACHE_VERSION and \
+               time.time() - cached['fetched'] < COUNTRY_LIST_CACHE_TTL:
+                return [cached['codes'], cached['names']]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        codes, names = self.FetchCountryLists()
+        if codes and path is not None:
+            try:
+                temp = path + '.tmp'
+                with open(temp, 'w') as f:
+                    json.dump({'version': COUNTRY_LIST_CACHE_VERSION,
+                               'fetched': time.time(), 'codes': codes,
+                               'names': names}, f)
+                os.replace(temp, path)
+            except OSError:
+                pass
+        return [codes, names]
+
+    # Reads the country list from the registration page.  The page is parsed
+    # as it arrives and the rest of it is not read once the list has ended.
+    def FetchCountryLists(self):
+        url = "https://setup.myharmony.com/MartiniWeb/Account/Register"
+        key, conn, response = self.OpenUrl(
+            "GET", url, headers={'Accept-Encoding': 'identity'})
+        try:
+            if response.status != 200:
+                raise urllib.error.HTTPError(url, response.status,
+                                             response.reason,
+                                             response.headers, None)
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            parser = CountryListHTMLParser()
+            while not parser.done:
+                chunk = response.read(COUNTRY_LIST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(decoder.decode(chunk))
+        finally:
+            self.ReleaseUrl(key, conn, response)
+        return (parser.country_codes, parser.countries)
 
     def AddRemote(self, serialNumber, skinId, usbPid, usbVid):
         self.GetHousehold()
@@ -590,8 +1776,9 @@ class MHManager():
             result = self.client.service['AccountManager']. \
                 CreateNewAccountInMyHousehold()
             accountId = result.Id
+            self.InvalidateHousehold()
 
-        remoteInfo = self.client.factory.create(
+        remoteInfo = self.Create(
             '{' + ACCOUNT_NS + '}remoteInfo')
         remoteInfo.AccountId = accountId
         remoteInfo.KeyPadLayout = "Undefined"
@@ -599,32 +1786,33 @@ class MHManager():
         remoteInfo.SkinId = skinId
         remoteInfo.UsbPid = usbPid
         remoteInfo.UsbVid = usbVid
-        return self.client.service['UserAccountDirector'].AddRemoteToAccount(
+        result = self.client.service['UserAccountDirector'].AddRemoteToAccount(
             remoteInfo)
+        self.InvalidateHousehold()
+        return result
 
     # Removes a remote from an account.
     def DeleteRemote(self, remoteId):
         account = self.GetAccountForRemote(remoteId)
         self.client.service['AccountManager'].RemoveAccountFromHousehold(
             account.Id)
+        self.InvalidateHousehold()
+
+    # Returns the ProductCatalog of remotes supported by this web interface.
+    # It is fetched once per session.
+    def GetProductCatalog(self):
+        if self.productCatalog is None:
+            self.productCatalog = ProductCatalog(
+                self.client.service['ProductsManager'].GetHarmonyProducts())
+        return self.productCatalog
 
     # Returns a set of the remote skins supported by this web interface.
     def GetSupportedRemoteSkinIds(self):
-        products = self.client.service['ProductsManager'].GetHarmonyProducts()
-        skinIds = set()
-        for product in products.HarmonyProduct:
-            skinIds.add(int(product.SkinId))
-        return skinIds
+        return self.GetProductCatalog().skinIds
 
     # Returns a list of the remote names supported by this web interface.
     def GetSupportedRemoteNames(self):
-        products = self.client.service['ProductsManager'].GetHarmonyProducts()
-        remoteNames = set()
-        for product in products.HarmonyProduct:
-            remoteNames.add(product.DisplayName)
-        remoteNames = list(remoteNames)
-        remoteNames.sort()
-        return remoteNames
+        return self.GetProductCatalog().remoteNames
 
     def GetGlobalRemote(self, serialNumber):
         return self.client.service['RemoteManager'].GetGlobalRemote(
@@ -642,13 +1830,13 @@ class MHManager():
     # Sets the "Remote Name" - used for Harmony Link to identify the room where
     # the link is located
     def SetRemoteName(self, remoteId, remoteName):
-        remoteProperties = self.client.factory.create('{' + ACCOUNT_NS
-                                                      + '}RemoteProperties')
+        remoteProperties = self.Create('{' + ACCOUNT_NS + '}RemoteProperties')
         remoteProperties.IsActiveRemote = True
         remoteProperties.IsLocked = False
         remoteProperties.RemoteName = remoteName
         result = self.client.service['RemoteManager'].SaveRemoteProperties(
             remoteId, remoteProperties)
+        self.InvalidateHousehold()
         if result == "Successful":
             return True
         else:
@@ -659,12 +1847,10 @@ class MHManager():
         account = self.GetAccountForRemote(remoteId)
         devices = self.GetDevices(remoteId)
         devicesWithCapabilities = \
-            self.client.factory.create('{' + ACTIVITY_NS
-                                       + '}DevicesWithCapabilities')
+            self.Create('{' + ACTIVITY_NS + '}DevicesWithCapabilities')
         for device in devices:
             deviceWithCapabilities = \
-                self.client.factory.create('{' + ACTIVITY_NS +
-                                           '}DeviceWithCapabilities')
+                self.Create('{' + ACTIVITY_NS + '}DeviceWithCapabilities')
             deviceWithCapabilities.DeviceId = device.Id
             deviceWithCapabilities.DeviceType = "Unknown"
             deviceWithCapabilities.PrioritizedCapabilities = \
@@ -694,16 +1880,14 @@ class MHManager():
     def GetActivityRolesAndDevices(self, remoteId, activityType):
         account = self.GetAccountForRemote(remoteId)
         activityTypes = \
-            self.client.factory.create('{' + ACTIVITY_NS + '}ActivityTypes')
+            self.Create('{' + ACTIVITY_NS + '}ActivityTypes')
         activityTypes.ActivityType.append(activityType)
         devices = self.GetDevices(remoteId)
         devicesWithCapabilities = \
-            self.client.factory.create('{' + ACTIVITY_NS
-                                       + '}DevicesWithCapabilities')
+            self.Create('{' + ACTIVITY_NS + '}DevicesWithCapabilities')
         for device in devices:
             deviceWithCapabilities = \
-                self.client.factory.create('{' + ACTIVITY_NS +
-                                           '}DeviceWithCapabilities')
+                self.Create('{' + ACTIVITY_NS + '}DeviceWithCapabilities')
             deviceWithCapabilities.DeviceId = device.Id
             deviceWithCapabilities.DeviceType = "Unknown"
             deviceWithCapabilities.PrioritizedCapabilities = \
@@ -723,10 +1907,12 @@ class MHManager():
         activityTemplate.devices = []
         activityTemplate.devicesWithInputs = []
         activityTemplate.roles = []
+        inputNamesByDevice = self.GetDeviceInputNamesForDevices(
+            [device.Id for device in devices])
         for device in devices:
             deviceNames[device.Id.Value] = device.Name
             activityTemplate.devices.append((device.Name, device.Id))
-            inputNames = self.GetDeviceInputNames(device.Id)
+            inputNames = inputNamesByDevice.get(IdKey(device.Id))
             if inputNames:
                 activityTemplate.devicesWithInputs.append(
                     (device.Name, device.Id, inputNames))
@@ -767,18 +1953,18 @@ class MHManager():
     # Creates a 'Roles' structure and returns it
     # deviceInfo is a list of (deviceId, selectedInputName)
     def CreateRoles(self, deviceInfo):
-        roles = self.client.factory.create('{' + ACTIVITY_NS + '}Roles')
+        roles = self.Create('{' + ACTIVITY_NS + '}Roles')
         deviceNum = 1
         for device in deviceInfo:
             deviceId, inputName = device
-            role = self.client.factory.create(
+            role = self.Create(
                 '{' + ACTIVITY_NS + '}PassThroughActivityRole')
             role.DeviceId = deviceId
             role.Id = None
             role.PowerOffOrder = deviceNum
             role.PowerOnOrder = deviceNum
             if inputName:
-                role.SelectedInput = self.client.factory.create(
+                role.SelectedInput = self.Create(
                     '{' + ACTIVITY_NS + '}SelectedInput')
                 role.SelectedInput.Id = None
                 role.SelectedInput.Name = inputName
@@ -789,10 +1975,10 @@ class MHManager():
         return roles
 
     def CreateRolesByTemplate(self, saveActivityTemplate):
-        roles = self.client.factory.create('{' + ACTIVITY_NS + '}Roles')
+        roles = self.Create('{' + ACTIVITY_NS + '}Roles')
         for roleType, deviceId, inputName in saveActivityTemplate.roles:
-            role = self.client.factory.create('{' + ACTIVITY_NS + '}' +
-                                              roleType)
+            role = self.Create('{' + ACTIVITY_NS + '}' +
+                               roleType)
             role.DeviceId = deviceId
             role.Id = None
             if inputName or inputName == '':
@@ -808,7 +1994,7 @@ class MHManager():
     def SaveWatchTVActivity(self, remoteId, deviceInfo, activity=None):
         account = self.GetAccountForRemote(remoteId)
         if not activity:
-            activity = self.client.factory.create(
+            activity = self.Create(
                 '{' + ACTIVITY_NS + '}Activity')
             activity.AccountId = account.Id
             activity.ActivityGroup = "VirtualGeneric"
@@ -828,7 +2014,7 @@ class MHManager():
     def SaveActivityByTemplate(self, remoteId, saveActivityTemplate, activity):
         accountId = self.GetAccountForRemote(remoteId).Id
         if not activity:
-            activity = self.client.factory.create(
+            activity = self.Create(
                 '{' + ACTIVITY_NS + '}Activity')
             activity.AccountId = accountId
             activity.ActivityGroup = "VirtualGeneric"
@@ -848,15 +2034,14 @@ class MHManager():
     # Saves the specified activity
     def SaveActivity(self, remoteId, activity):
         accountId = self.GetAccountForRemote(remoteId).Id
-        activities = self.client.factory.create('{' + ACTIVITY_NS
-                                                + '}Activities')
+        activities = self.Create('{' + ACTIVITY_NS + '}Activities')
         activities.Activity.append(activity)
         return self.client.service['ActivityManager'].SaveActivities(
             accountId, activities)
 
     # Deletes the specified activity
     def DeleteActivity(self, activity):
-        activityIds = self.client.factory.create('{' + DATA_NS + '}activityIds')
+        activityIds = self.Create('{' + DATA_NS + '}activityIds')
         activityIds.ActivityId.append(activity.Id)
         return self.client.service['ActivityManager'].DeleteActivities(
             activity.AccountId, activityIds)
@@ -874,7 +2059,18 @@ class MHManager():
         return None
 
     def GetDeviceInputNames(self, deviceId):
-        features = self.GetUserFeatures(deviceId)
+        return self.GetInputNamesFromFeatures(self.GetUserFeatures(deviceId))
+
+    # Returns a dictionary mapping IdKey(deviceId) to the input names for each
+    # of the given devices, using a single GetUserFeatures request.
+    def GetDeviceInputNamesForDevices(self, deviceIds):
+        inputNames = {}
+        features = self.GetUserFeaturesForDevices(deviceIds)
+        for key in features:
+            inputNames[key] = self.GetInputNamesFromFeatures(features[key])
+        return inputNames
+
+    def GetInputNamesFromFeatures(self, features):
         if features:
             for feature in features.DeviceFeature:
                 try:
@@ -889,7 +2085,7 @@ class MHManager():
         return None
 
     def GetUserFeatures(self, deviceId):
-        deviceIds = self.client.factory.create('{' + DATA_NS + '}deviceIds')
+        deviceIds = self.Create('{' + DATA_NS + '}deviceIds')
         deviceIds.DeviceId.append(deviceId)
         result = self.client.service['UserFeatureManager'].GetUserFeatures(
             deviceIds)
@@ -898,6 +2094,21 @@ class MHManager():
                 Value
         return None
 
+    # Returns a dictionary mapping IdKey(deviceId) to the user features for
+    # each of the given devices, using a single GetUserFeatures request.
+    def GetUserFeaturesForDevices(self, deviceIds):
+        features = {}
+        if not deviceIds:
+            return features
+        ids = self.Create('{' + DATA_NS + '}deviceIds')
+        for deviceId in deviceIds:
+            ids.DeviceId.append(deviceId)
+        result = self.client.service['UserFeatureManager'].GetUserFeatures(ids)
+        if result:
+            for entry in result.KeyValueOfDeviceIdArrayOfDeviceFeatureeiEyJu8p:
+                features[IdKey(entry.Key)] = entry.Value
+        return features
+
     def SaveUserFeatures(self, userFeatures):
         return self.client.service['UserFeatureManager'].SaveUserFeatures(
             userFeatures)
@@ -933,21 +2144,20 @@ class MHManager():
     # powerFeatureActions is an array of (IRPressAction/IRDelayAction, Command,
     # Duration); actionType is "PowerToggle", "PowerOn", etc.
     def SavePowerFeature(self, powerFeature, powerFeatureActions, actionType):
-        ufActions = self.client.factory.create('{' + USER_FEATURE_NS +
-                                             '}Actions')
+        ufActions = self.Create('{' + USER_FEATURE_NS + '}Actions')
         actionNum = 1
         for pfAction in powerFeatureActions:
             ufAction = None
             if pfAction[0] == "IRPressAction":
-                ufAction = self.client.factory.create('{' + USER_FEATURE_NS +
-                                                      '}IRPressAction')
+                ufAction = self.Create('{' + USER_FEATURE_NS +
+                                       '}IRPressAction')
                 ufAction.ActionId = 0
                 ufAction.Order = actionNum
                 ufAction.Duration = pfAction[2]
                 ufAction.IRCommandName = pfAction[1]
             elif pfAction[0] == "IRDelayAction":
-                ufAction = self.client.factory.create('{' + USER_FEATURE_NS +
-                                                      '}IRDelayAction')
+                ufAction = self.Create('{' + USER_FEATURE_NS +
+                                       '}IRDelayAction')
                 ufAction.ActionId = 3
                 ufAction.Order = actionNum
                 ufAction.Delay = pfAction[2]
@@ -959,8 +2169,7 @@ class MHManager():
             powerFeature.PowerToggleActions = ufActions
         elif actionType == "PowerOn":
             powerFeature.PowerOnActions = ufActions
-        deviceFeatures = self.client.factory.create('{' + USER_FEATURE_NS
-                                                    + '}DeviceFeatures')
+        deviceFeatures = self.Create('{' + USER_FEATURE_NS + '}DeviceFeatures')
         deviceFeatures.DeviceFeature.append(powerFeature)
         return self.client.service['UserFeatureManager'].SaveUserFeatures(
             deviceFeatures)
@@ -968,56 +2177,243 @@ class MHManager():
     # Adds a learned IR command (if the command name does not already exist) or
     # updates the IR command for the specified command name and device.
     def UpdateIRCommand(self, commandName, rawSequence, deviceId):
-        result = self.client.service['InfraredAnalysisManager'].AnalyzeInfrared(
+        errors = self.UpdateIRCommands([(commandName, rawSequence)], deviceId)
+        return errors.get(commandName)
+
+    # Adds or updates several IR commands for a device.  commands is a list of
+    # (commandName, rawSequence).  The signals are analyzed concurrently and
+    # the commands are then saved MAX_OPERATIONS_PER_BAG at a time.  Returns a
+    # dictionary mapping the name of each command that failed to an error
+    # message; it is empty if all of them were saved.
+    def UpdateIRCommands(self, commands, deviceId):
+        errors = {}
+        results = self.Gather(*[(self.AnalyzeInfrared, rawSequence)
+                                for commandName, rawSequence in commands],
+                              return_exceptions=True)
+        operations = []
+        accountId = self.GetAccountIdForDevice(deviceId)
+        for (commandName, rawSequence), result in zip(commands, results):
+            # result is the exception if the call failed.
+            keyCode = getattr(result, 'KeyCode', None)
+            if keyCode is None:
+                errors[commandName] = "AnalyzeInfrared failed:" + str(result)
+                continue
+            operation = self.Create(
+                '{' + DM_OPERATION_NS + '}AddCommandOperation'
+            )
+            operation.ParentAccount = accountId
+            operation.DeviceId = deviceId
+            operation.KeyCode = keyCode
+            operation.Name = commandName
+            operation.RawInfrared = rawSequence
+            operations.append((commandName, operation))
+        chunks = list(Chunks(operations, MAX_OPERATIONS_PER_BAG))
+        results = self.Gather(*[(self.UpdateMultiple, accountId,
+                                 [operation for name, operation in chunk])
+                                for chunk in chunks], return_exceptions=True)
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                error = "UpdateMultiple failed:" + str(result)
+            elif result is None:
+                error = "UpdateMultiple failed"
+            else:
+                continue
+            for commandName, operation in chunk:
+                errors[commandName] = error
+        return errors
+
+    def AnalyzeInfrared(self, rawSequence):
+        return self.client.service['InfraredAnalysisManager'].AnalyzeInfrared(
             None, rawSequence)
-        try:
-            result.KeyCode
-        except:
-            return "AnalyzeInfrared failed:" + str(result)
 
-        operation = self.client.factory.create('{' + OPERATION_NS
-                                               + '}OperationBag')
-        operation.ParentAccount = self.GetAccountIdForDevice(deviceId)
-        operation.Items.Operation = self.client.factory.create(
-            '{' + DM_OPERATION_NS + '}AddCommandOperation'
-        )
-        operation.Items.Operation.ParentAccount = operation.ParentAccount
-        operation.Items.Operation.DeviceId = deviceId
-        operation.Items.Operation.KeyCode = result.KeyCode
-        operation.Items.Operation.Name = commandName
-        operation.Items.Operation.RawInfrared = rawSequence
-        result = self.client.service['DeviceManager'].UpdateMultiple(operation)
-        if result is None:
-            return "UpdateMultiple failed"
-        return None
+    # Sends the given device manager operations in a single OperationBag.
+    def UpdateMultiple(self, accountId, operations):
+        operation = self.Create('{' + OPERATION_NS + '}OperationBag')
+        operation.ParentAccount = accountId
+        operation.Items.Operation = operations
+        return self.client.service['DeviceManager'].UpdateMultiple(operation)
 
     # Deletes an IR command (if it is a user-added one) or removes the override
     # if the command is an officially provided one.
     def DeleteIRCommand(self, commandId, deviceId):
-        deviceIds = self.client.factory.create('{' + DATA_NS + '}deviceIds')
+        return self.DeleteIRCommands([commandId], deviceId)
+
+    # Deletes several IR commands for a device with one button map request and
+    # one OperationBag.  The server reports success or failure for the batch
+    # as a whole, so this returns None if the commands were deleted or a
+    # single error message if they were not.
+    def DeleteIRCommands(self, commandIds, deviceId):
+        values = [commandId.Value for commandId in commandIds]
+        if not values:
+            return None
+        deviceIds = self.Create('{' + DATA_NS + '}deviceIds')
         deviceIds.DeviceId.append(deviceId)
-        taughtCommandIds = self.client.factory.create('{' + ARRAYS_NS
-                                                      + '}taughtCommandIds')
-        taughtCommandIds.long = commandId.Value
+        taughtCommandIds = self.Create('{' + ARRAYS_NS + '}taughtCommandIds')
+        taughtCommandIds.long = values
         result = self.client.service['UserButtonMappingManager']. \
             DeleteTaughtDeviceModeCommandButtonMaps(deviceIds, taughtCommandIds)
         if result is not None:
             return "DeleteTaughtDeviceModeCommandButtonMaps:" + str(result)
 
-        operation = self.client.factory.create('{' + OPERATION_NS
-                                               + '}OperationBag')
-        operation.ParentAccount = self.GetAccountIdForDevice(deviceId)
-        operation.Items.Operation = self.client.factory.create(
+        accountId = self.GetAccountIdForDevice(deviceId)
+        operation = self.Create(
             '{' + DM_OPERATION_NS + '}DeleteCommandOperation'
         )
-        operation.Items.Operation.ParentAccount = operation.ParentAccount
-        operation.Items.Operation.DeviceId = deviceId
-        operation.Items.Operation.LanguageElementIds.long = commandId.Value
-        result = self.client.service['DeviceManager'].UpdateMultiple(operation)
+        operation.ParentAccount = accountId
+        operation.DeviceId = deviceId
+        operation.LanguageElementIds.long = values
+        result = self.UpdateMultiple(accountId, operation)
         if result is None:
             return "UpdateMultiple failed"
         return None
 
+# An editable user button map (as used by ActivityCompiled remotes).  The
+# buttons are indexed by ButtonKey once, so any number of Assign() calls can
+# be made before the whole map is saved with one Save().
+class UserButtonMapEditor:
+    def __init__(self, mhMgr, userButtonMap):
+        self.mhMgr = mhMgr
+        self.userButtonMap = userButtonMap
+        accountId = mhMgr.GetAccountIdForDevice(userButtonMap.DeviceId)
+        remote = mhMgr.GetRemoteForAccountId(accountId)
+        self.surfaceId = remote.Surfaces.Surface[0].Id
+        self.buttons = AsList(userButtonMap.Buttons.AbstractRemoteButton)
+        userButtonMap.Buttons.AbstractRemoteButton = self.buttons
+        self.index = {}
+        for i, bmEntry in enumerate(self.buttons):
+            key = getattr(bmEntry, 'ButtonKey', None)
+            if key is not None and key not in self.index:
+                self.index[key] = i
+
+    # Assigns command to button (an entry from GetRemoteCanvas()).
+    def Assign(self, button, command):
+        i = self.index.get(button.ButtonKey)
+        if i is not None:
+            bmEntry = self.buttons[i]
+        else:
+            bmEntry = self.mhMgr.Create('{' + USER_BUTTON_MAPPING_NS
+                                        + '}HardRemoteButton')
+            bmEntry.ButtonAction = self.mhMgr.Create(
+                '{' + USER_BUTTON_MAPPING_NS + '}ButtonCommandAction')
+            self.index[button.ButtonKey] = len(self.buttons)
+            self.buttons.append(bmEntry)
+        bmEntry.ButtonAction.EventType = 0
+        bmEntry.ButtonAction.Id = 0
+        bmEntry.ButtonAction.Order = 0
+        bmEntry.ButtonAction.CommandName = command.Name
+        bmEntry.ButtonAction.DeviceId = self.userButtonMap.DeviceId
+        bmEntry.ButtonAction.FunctionId = command.FunctionId
+        bmEntry.ButtonDoublePressAction = None
+        bmEntry.ButtonId = 0
+        bmEntry.ButtonLongPressAction = None
+        bmEntry.ButtonState = button.ButtonState
+        bmEntry.FunctionGroupType = button.FunctionGroupType
+        bmEntry.ButtonKey = button.ButtonKey
+
+    def Save(self):
+        self.userButtonMap.ButtonMapSurfaceId = self.surfaceId
+        self.userButtonMap.SurfaceId = self.surfaceId
+        buttonMaps = self.mhMgr.Create('{' + USER_BUTTON_MAPPING_NS
+                                       + '}ButtonMaps')
+        buttonMaps.AbstractButtonMap = self.userButtonMap
+        self.mhMgr.client.service['UserButtonMappingManager'] \
+            .SaveButtonMaps(buttonMaps)
+
+# Exposes the MHManager operations as coroutines, e.g.
+#   remotes = await asyncMgr.GetRemotes()
+# The blocking calls run on a thread pool shared by all instances, so one
+# event loop can drive many accounts (one AsyncMHManager per account) with a
+# fixed number of threads.  Each instance has at most max_concurrency
+# requests in flight.
+#
+# Creating an MHManager loads the WSDL, which blocks.  From a coroutine, use
+#   asyncMgr = await AsyncMHManager.Connect(**kwargs)
+# which does that on the shared pool.  AsyncMHManager(mhMgr) wraps an existing
+# manager; AsyncMHManager(**kwargs) creates one on the calling thread and must
+# not be used from within a running event loop.
+class AsyncMHManager:
+    executor = None
+    executorLock = threading.Lock()
+
+    def __init__(self, mhMgr=None, max_concurrency=MAX_ASYNC_CONCURRENCY,
+                 **kwargs):
+        if mhMgr is None:
+            mhMgr = MHManager(**kwargs)
+        self.mhMgr = mhMgr
+        self.maxConcurrency = max_concurrency
+        self.semaphore = None
+        AsyncMHManager.SharedExecutor()
+
+    @staticmethod
+    def SharedExecutor():
+        with AsyncMHManager.executorLock:
+            if AsyncMHManager.executor is None:
+                AsyncMHManager.executor = ThreadPoolExecutor(
+                    ASYNC_POOL_WORKERS)
+            return AsyncMHManager.executor
+
+    # Creates an AsyncMHManager with a new MHManager(**kwargs), which is
+    # built on the shared pool so that the event loop is not blocked.
+    @classmethod
+    async def Connect(cls, max_concurrency=MAX_ASYNC_CONCURRENCY, **kwargs):
+        loop = asyncio.get_running_loop()
+        mhMgr = await loop.run_in_executor(
+            AsyncMHManager.SharedExecutor(),
+            functools.partial(MHManager, **kwargs))
+        return cls(mhMgr, max_concurrency)
+
+    # Runs function(*args, **kwargs) on the shared pool, respecting the
+    # concurrency limit of this instance.
+    async def Call(self, function, *args, **kwargs):
+        # Created here so that it belongs to the running event loop.
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(
+                AsyncMHManager.executor,
+                functools.partial(self.mhMgr.RunInWorker, function, *args,
+                                  **kwargs))
+
+    # Any other MHManager method becomes a coroutine that runs it via Call().
+    def __getattr__(self, name):
+        attribute = getattr(self.mhMgr, name)
+        if not callable(attribute):
+            return attribute
+        async def method(*args, **kwargs):
+            return await self.Call(attribute, *args, **kwargs)
+        return method
+
+    async def Gather(self, *calls):
+        return await asyncio.gather(*[self.Call(*call) for call in calls])
+
+    # Like MHManager.GetConfig, but waits between polls without tying up a
+    # worker thread.
+    async def GetConfig(self, remote, filename, progress=None):
+        compileRequest = await self.Call(self.mhMgr.StartCompile, remote)
+        schedule = ConfigPollSchedule()
+        while True:
+            done, retryAfter = await self.Call(self.mhMgr.PollConfig,
+                                               compileRequest, filename,
+                                               progress)
+            if done:
+                return
+            delay = schedule.NextDelay(retryAfter)
+            if delay is None:
+                raise Exception("Failed to download config file")
+            await asyncio.sleep(delay)
+
+# The remote models supported by the web service, built from one
+# GetHarmonyProducts result.
+class ProductCatalog:
+    def __init__(self, products):
+        self.skinIds = set()        # Supported skin ids (set of int)
+        remoteNames = set()
+        for product in products.HarmonyProduct:
+            self.skinIds.add(int(product.SkinId))
+            remoteNames.add(product.DisplayName)
+        self.remoteNames = sorted(remoteNames) # Sorted display names
+
 class ActivityTemplate:
     def __init__(self):
         self.devices = None # List of (Device Name, DeviceId)
@@ -1053,9 +2449,14 @@ class Secrets:
         Secret.password_lookup(self.SCHEMA, self.KEY, None,
             self._finishLookup, callback)
 
-    def storeUser(self, username, password, callback=None):
+    # session, if given, is a saved MHManager login session; it is passed to
+    # the fetchUser() callback as a third argument.
+    def storeUser(self, username, password, callback=None, session=None):
+        secret = [username, password]
+        if session is not None:
+            secret.append(session)
         Secret.password_store(self.SCHEMA, self.KEY, Secret.COLLECTION_DEFAULT,
-            "MHGUI", json.dumps([username, password]), None,
+            "MHGUI", json.dumps(secret), None,
             self._finishStore, callback)
 
     def clearUser(self):
@@ -1091,6 +2492,17 @@ class CountryListHTMLParser(HTMLParser):
         self.country_codes = []
         self.countries = []
         self.country_code = None
+        # The text of the current option, which may arrive in several pieces
+        # when the page is fed in chunks.
+        self.country_text = []
+        # Set once the country list has been read.
+        self.done = False
+    def end_option(self):
+        if self.country_code is not None:
+            self.country_codes.append(self.country_code)
+            self.countries.append(''.join(self.country_text))
+            self.country_code = None
+        self.country_text = []
     def handle_starttag(self, tag, attrs):
         if tag == 'select' and ('id', 'region') in attrs and \
                 ('name', 'region') in attrs:
@@ -1098,14 +2510,18 @@ class CountryListHTMLParser(HTMLParser):
             return
         if self.in_country_section:
             if tag == 'option':
+                # The end tag of an option is optional.
+                self.end_option()
                 for attr in attrs:
                     if attr[0] == 'value':
                         self.country_code = attr[1]
     def handle_data(self, data):
         if self.country_code is not None:
-            self.country_codes.append(self.country_code)
-            self.countries.append(data)
-            self.country_code = None
+            self.country_text.append(data)
     def handle_endtag(self, tag):
-        if self.in_country_section and tag == 'select':
+        if self.in_country_section and tag == 'option':
+            self.end_option()
+        elif self.in_country_section and tag == 'select':
+            self.end_option()
             self.in_country_section = False
+            self.done = True
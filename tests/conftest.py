@@ -0,0 +1,70 @@
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Fixtures for tests that run MHManager against the local stand-in server
+# (benchmarks/harmony_server.py).
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'benchmarks'))
+
+from congruity.mhmanager import MHManager
+from harmony_server import HarmonyServer, Household, LocalConnectionPool
+
+PROXY_VARIABLES = ['http_proxy', 'https_proxy', 'all_proxy', 'no_proxy']
+
+@pytest.fixture(scope='session')
+def cache_directory(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('cache'))
+
+# Keeps the WSDL snapshot out of the user's cache, and makes sure requests
+# are not sent to a proxy instead of the local server.
+@pytest.fixture
+def environment(cache_directory, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', cache_directory)
+    for name in PROXY_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+        monkeypatch.delenv(name.upper(), raising=False)
+
+@pytest.fixture
+def server():
+    server = HarmonyServer(Household(accounts=2, devicesPerAccount=3,
+                                     commandsPerDevice=5)).Start()
+    yield server
+    server.Stop()
+
+# Returns a logged in MHManager that sends its requests through pool.
+def NewManager(pool):
+    mhMgr = MHManager(True, pool=pool, product_cache=None)
+    mhMgr.Login("test@example.com", "password")
+    return mhMgr
+
+@pytest.fixture
+def manager(environment, server):
+    mhMgr = NewManager(LocalConnectionPool(server.url))
+    yield mhMgr
+    mhMgr.pool.Close()
+
+# Returns the number of requests the server has had for name, e.g.
+# "DeviceManager.SearchGlobalDevices".
+def Requests(server, name):
+    return server.Requests().get(name, (0, 0))[0]
@@ -0,0 +1,55 @@
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+import codecs
+
+from congruity.mhmanager import CountryListHTMLParser
+
+PAGE = ('<html><body><form><select id="region" name="region">'
+        '<option value="">- Select Country -</option>'
+        '<option value="US">United States</option>'
+        '<option value="CI">C&ocirc;te d&#39;Ivoire</option>'
+        '<option value="AX">Åland Islands'
+        '<option value="CA">Canada</option>'
+        '</select><select id="other"><option value="x">Other</option>'
+        '</select></form></body></html>')
+CODES = ['', 'US', 'CI', 'AX', 'CA']
+COUNTRIES = ['- Select Country -', 'United States', "Côte d'Ivoire",
+             'Åland Islands', 'Canada']
+
+def Parse(pieces):
+    parser = CountryListHTMLParser()
+    for piece in pieces:
+        if parser.done:
+            break
+        parser.feed(piece)
+    return (parser.country_codes, parser.countries)
+
+def test_whole_page():
+    assert Parse([PAGE]) == (CODES, COUNTRIES)
+
+def test_every_split_offset():
+    for i in range(len(PAGE) + 1):
+        assert Parse([PAGE[:i], PAGE[i:]]) == (CODES, COUNTRIES), i
+
+# As FetchCountryLists() does it, with the UTF-8 split at every byte.
+def test_every_byte_split_offset():
+    data = PAGE.encode('utf-8')
+    for i in range(len(data) + 1):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        pieces = [decoder.decode(data[:i]), decoder.decode(data[i:])]
+        assert Parse(pieces) == (CODES, COUNTRIES), i
@@ -0,0 +1,62 @@
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from congruity.mhmanager import CopyObject, IdKey
+
+from conftest import Requests
+
+HOUSEHOLD = "AccountManager.GetMyHousehold"
+
+def test_lookups(manager, server):
+    remotes = manager.GetRemotes()
+    assert len(remotes) == 2
+    accountIds = set()
+    for remote in remotes:
+        account = manager.GetAccountForRemote(remote.Id)
+        assert [IdKey(r.Id) for r in account.Remotes.Remote] == \
+            [IdKey(remote.Id)]
+        accountIds.add(IdKey(account.Id))
+        devices = manager.GetDevices(remote.Id)
+        assert len(devices) == 3
+        for device in devices:
+            assert IdKey(manager.GetAccountIdForDevice(device.Id)) == \
+                IdKey(account.Id)
+    assert len(accountIds) == 2
+    assert Requests(server, HOUSEHOLD) == 1
+
+# Ids are looked up by value, not by the identity of the id objects.
+def test_lookup_by_value(manager):
+    remote = manager.GetRemotes()[0]
+    device = manager.GetDevices(remote.Id)[0]
+    account = manager.GetAccountForRemote(CopyObject(remote.Id))
+    assert IdKey(manager.GetAccountIdForDevice(CopyObject(device.Id))) == \
+        IdKey(account.Id)
+
+def test_unknown_ids(manager):
+    remote = manager.GetRemotes()[0]
+    unknown = CopyObject(remote.Id)
+    unknown.Value = -1
+    assert manager.GetAccountForRemote(unknown) is None
+    assert manager.GetAccountIdForDevice(unknown) is None
+
+def test_index_follows_household(manager, server):
+    remote = manager.GetRemotes()[0]
+    manager.DeleteRemote(remote.Id)
+    assert len(manager.GetRemotes()) == 1
+    assert manager.GetAccountForRemote(remote.Id) is None
+    assert Requests(server, HOUSEHOLD) == 2
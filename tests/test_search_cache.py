@@ -0,0 +1,90 @@
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import congruity.mhmanager
+
+from conftest import Requests
+
+SEARCH = "DeviceManager.SearchGlobalDevices"
+
+def Models(result):
+    return [(match.Manufacturer, match.DeviceModel)
+            for match in congruity.mhmanager.SearchMatches(result)]
+
+# The result the server gives for a search, bypassing the cache.
+def ServerResult(mhMgr, manufacturer, modelNumber, maxResults):
+    return mhMgr.client.service['DeviceManager'].SearchGlobalDevices(
+        manufacturer, modelNumber, "Unknown", "DidYouMeanMatch", maxResults)
+
+def test_repeated_search(manager, server):
+    first = manager.SearchDevices("Sony", "A-1", 20)
+    assert Models(manager.SearchDevices("sony", "a-1", 20)) == Models(first)
+    assert Requests(server, SEARCH) == 1
+
+def test_refinement_of_complete_result(manager, server):
+    # Sony has fewer than 200 "A" models, so this gets all of them.
+    manager.SearchDevices("Sony", "A", 200)
+    for modelNumber in ["a-", "a-1", "a-19", "a-1900", "a-99", "ax"]:
+        requests = Requests(server, SEARCH)
+        result = manager.SearchDevices("Sony", modelNumber, 200)
+        assert Requests(server, SEARCH) == requests, modelNumber
+        assert Models(result) == \
+            Models(ServerResult(manager, "Sony", modelNumber, 200))
+    result = manager.SearchDevices("Sony", "ax", 200)
+    assert Requests(server, SEARCH) == 7
+    assert result.Status == "NoMatchFound"
+    assert Models(result) == []
+
+def test_refinement_with_fewer_results(manager, server):
+    manager.SearchDevices("Sony", "A", 200)
+    result = manager.SearchDevices("Sony", "a-1", 5)
+    assert Requests(server, SEARCH) == 1
+    assert Models(result) == Models(ServerResult(manager, "Sony", "a-1", 5))
+
+def test_refinement_of_truncated_result(manager, server):
+    manager.SearchDevices("Sony", "", 10)
+    result = manager.SearchDevices("Sony", "b", 10)
+    assert Requests(server, SEARCH) == 2
+    assert len(Models(result)) == 10
+    assert all(model.startswith("B") for name, model in Models(result))
+
+def test_least_recently_used_is_evicted(manager, server, monkeypatch):
+    monkeypatch.setattr(congruity.mhmanager, 'DEVICE_SEARCH_CACHE_SIZE', 2)
+    manager.SearchDevices("Sony", "", 5)
+    manager.SearchDevices("LG", "", 5)
+    manager.SearchDevices("Sony", "", 5)
+    manager.SearchDevices("Denon", "", 5)
+    assert Requests(server, SEARCH) == 3
+    # LG was used least recently, so it was evicted rather than Sony.
+    manager.SearchDevices("Sony", "", 5)
+    assert Requests(server, SEARCH) == 3
+    manager.SearchDevices("LG", "", 5)
+    assert Requests(server, SEARCH) == 4
+    assert len(manager.searchCache) == 2
+
+def test_new_client_empties_cache(manager, server):
+    manager.SearchDevices("Sony", "A", 200)
+    manager.clientGeneration += 1
+    manager.SearchDevices("Sony", "A", 200)
+    manager.SearchDevices("Sony", "A-1", 200)
+    assert Requests(server, SEARCH) == 2
+
+def test_results_are_copies(manager, server):
+    result = manager.SearchDevices("Sony", "", 5)
+    result.Matches.PublicDeviceSearchMatch[0].DeviceModel = "Changed"
+    assert Models(manager.SearchDevices("Sony", "", 5))[0][1] != "Changed"
@@ -0,0 +1,100 @@
+# Copyright 2026 agent
+#
+# This file is part of congruity.
+#
+# congruity is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# congruity is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with congruity.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import base64
+import json
+import re
+
+import pytest
+
+from congruity.mhmanager import ExchangeKeys, RecordingConnectionPool, \
+    ReplayConnectionPool
+
+from conftest import NewManager, Requests
+from harmony_server import LocalConnectionPool
+
+SEARCH = "DeviceManager.SearchGlobalDevices"
+SEARCH_URL = "https://svcs.myharmony.com/DeviceManager.svc"
+SEARCH_HEADERS = {'SOAPAction': '"http://tempuri.org/IDeviceManager/'
+                                'SearchGlobalDevices"'}
+
+class LocalRecordingPool(LocalConnectionPool, RecordingConnectionPool):
+    pass
+
+def Manufacturers(result):
+    return set(match.Manufacturer
+               for match in result.Matches.PublicDeviceSearchMatch)
+
+# Records a login and two searches against the local server, and returns
+# the path of the recording.
+@pytest.fixture
+def recording(environment, server, tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    mhMgr = NewManager(LocalRecordingPool(server.url, path))
+    mhMgr.SearchDevices("Sony", "", 5)
+    mhMgr.SearchDevices("LG", "", 5)
+    mhMgr.pool.Close()
+    return path
+
+def test_keys():
+    exact, loose = ExchangeKeys("POST", SEARCH_URL + "?a=1", b"body",
+                                SEARCH_HEADERS)
+    assert (exact, loose) == ExchangeKeys("POST", SEARCH_URL + "?a=1",
+                                          "body", SEARCH_HEADERS)
+    otherExact, otherLoose = ExchangeKeys("POST", SEARCH_URL + "?a=2",
+                                          b"other", SEARCH_HEADERS)
+    assert otherExact != exact
+    assert otherLoose == loose
+    assert ExchangeKeys("POST", SEARCH_URL, b"body", {})[1] != loose
+    assert ExchangeKeys("GET", SEARCH_URL, b"body", SEARCH_HEADERS)[1] != \
+        loose
+
+def test_tokens_are_redacted(recording):
+    with open(recording) as f:
+        exchanges = [json.loads(line) for line in f]
+    bodies = b''.join(base64.b64decode(exchange['body'])
+                      for exchange in exchanges)
+    cookies = [value for exchange in exchanges
+               for name, value in exchange['headers']
+               if name.lower() == 'set-cookie']
+    # The server's tokens and cookies are random 32 digit hex strings.
+    assert re.search(rb'[0-9a-f]{32}', bodies) is None
+    assert bodies.count(b'REDACTED') == 2
+    assert cookies == ['SecurityToken=REDACTED; Path=/']
+
+def test_exact_match(recording, server):
+    requests = server.Requests()
+    mhMgr = NewManager(ReplayConnectionPool(recording))
+    # In the opposite order to the recording; each gets its own reply.
+    assert Manufacturers(mhMgr.SearchDevices("LG", "", 5)) == {"LG"}
+    assert Manufacturers(mhMgr.SearchDevices("Sony", "", 5)) == {"Sony"}
+    assert server.Requests() == requests
+
+def test_loose_match(recording, server):
+    mhMgr = NewManager(ReplayConnectionPool(recording))
+    # Not recorded, so it gets the replies to the same operation in order,
+    # and then the last one again.
+    assert Manufacturers(mhMgr.SearchDevices("Denon", "", 5)) == {"Sony"}
+    assert Manufacturers(mhMgr.SearchDevices("Yamaha", "", 5)) == {"LG"}
+    assert Manufacturers(mhMgr.SearchDevices("Pioneer", "", 5)) == {"LG"}
+    assert Requests(server, SEARCH) == 2
+
+def test_no_match(recording):
+    pool = ReplayConnectionPool(recording)
+    with pytest.raises(Exception, match="No recorded response"):
+        pool.Request("POST", SEARCH_URL, b"body", {'SOAPAction': '"x"'})